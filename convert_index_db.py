@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+from time import time
+
+from lib import BlockIndex
+
+#
+# convert block index from blockindex.pdb (pickled list of dicts) into the
+# compact format read by parse_blockchain.py
+#
+
+pdb = 'blockindex.pdb'
+db = 'blockindex.npy'
+
+start = time()
+blockindex = BlockIndex.load(pdb)
+BlockIndex.save(db, blockindex)
+
+stop = time()
+print('converted {} blocks from {} to {} in {:.1f}s'.format(len(blockindex), pdb, db, stop-start))
@@ -2,6 +2,7 @@
 
 from bitcoin.rpc import RawProxy
 from time import time
+import os
 import pickle
 
 #
@@ -11,6 +12,11 @@ import pickle
 datadir = '/scratch/bitcoin-0.19.0.1-datadir/'
 db = 'blockhashes.pdb'
 
+# only fetch hashes of blocks that are not in the list written by an earlier
+# run yet; stored hashes that are no longer on the active chain (reorg) are
+# dropped and fetched again
+INCREMENTAL = True
+
 # open connection to bitcoin core
 p = RawProxy(btc_conf_file=datadir + '/bitcoin.conf')
 
@@ -19,8 +25,22 @@ tip = p.getblockcount()
 
 blockhashes = []
 start = time()
+
+# keep the stored hashes up to the last one that is still on the active
+# chain; after a reorg, only the last few stored hashes differ
+if INCREMENTAL and os.path.exists(db):
+    with open(db, 'rb') as fp:
+        blockhashes = pickle.load(fp)
+    stored = len(blockhashes)
+    del blockhashes[tip+1:]
+    while blockhashes and blockhashes[-1] != p.getblockhash(len(blockhashes)-1):
+        blockhashes.pop()
+    if len(blockhashes) < stored:
+        print('dropping {} stored block hashes no longer on active chain'.format(stored - len(blockhashes)))
+    print('reusing {} stored block hashes, fetching {} new ones'.format(len(blockhashes), tip+1 - len(blockhashes)))
+
 # get block hashes via 'getblockhash' RPC
-for i in range(tip+1):
+for i in range(len(blockhashes), tip+1):
     blockhashes.append(p.getblockhash(i))
     if (i > 0 and i % 10000 == 0):
 
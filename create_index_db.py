@@ -5,14 +5,37 @@ import pickle
 import plyvel
 import time
 import os
+import shutil
+import numpy as np
+from multiprocessing import Pool
 
-rows, columns = [int(x) for x in os.popen('stty size', 'r').read().split()]
+from lib import BlockIndex
+from lib.DiskBlockIndex import DiskBlockIndex
+
+columns = shutil.get_terminal_size().columns
 
 datadir = '/scratch/bitcoin-0.19.0.1-datadir/'
 blockhashdb = 'blockhashes.pdb'
+indexdb = 'blockindex.pdb'
+compactdb = 'blockindex.npy'
 
 DEBUG = False
 
+# read the block index with a single scan over all of its records ('scan') or
+# look up each block hash individually ('get'); in scan mode, records are
+# decoded by NUM_PROCESSES worker processes in chunks of CHUNK_SIZE records
+MODE = 'scan'
+NUM_PROCESSES = os.cpu_count()
+CHUNK_SIZE = 10000
+# decode block index records directly from bytes ('binary', see
+# lib/DiskBlockIndex.py) or using the hex-string based Stream class ('hex')
+DECODER = 'binary'
+# only decode blocks that are not in the index written by an earlier run yet;
+# blocks of the earlier index that are no longer on the active chain (reorg)
+# are dropped. Updates of fewer than CHUNK_SIZE blocks always use point
+# lookups, regardless of MODE.
+INCREMENTAL = True
+
 
 # Block status bits
 # Taken from Bitcoin Core's BlockStatus in src/chain.h
@@ -178,39 +201,12 @@ def endian(string, expected):
     else:
         return string
 
-# read array containing sorted block hashes of active chain
-with open(blockhashdb, 'rb') as fp:
-        blockhashes = pickle.load(fp)
-
-# open block index
-db = plyvel.DB(datadir + '/blocks/index', compression=None)
-
-# locate raw blocks using the active chain's hashes in blockhashes
-i = 0
-index = []
-start = time.time()
-tip = len(blockhashes)
-for pos, blockhash in enumerate(blockhashes):
-
-    # estimate remaining runtime
-    if (pos > 0 and pos % 10000 == 0):
-
-        # determine performance (in hashes per second) based on empirical data
-        runtime = time.time() - start
-        hps = (pos+1)/runtime
-
-        # estimate remaining runtime by dividing remaining work through
-        # estimated performance
-        time_left = ((tip+1) - (pos+1))/hps
-
-        print('{}/{} (elapsed time {:.1f}s, remaining time: {:.1f}s)'.format(pos, tip, runtime, time_left))
-
-    blockhash_serialized = endian(blockhash, 'big')
-    data = db.get('b'.encode('ascii') + bytes.fromhex(blockhash_serialized))
-
+def decode_hex(blockhash, data):
+    # decode the block index record (LevelDB value) of the block with hash
+    # blockhash and return the block's index data
 
     if DEBUG: print('-' * columns)
-    if DEBUG: print('{} {}'.format(pos, data.hex()))
+    if DEBUG: print('{} {}'.format(blockhash, data.hex()))
 
     # create data stream
     stream = Stream(data.hex())
@@ -226,18 +222,16 @@ for pos, blockhash in enumerate(blockhashes):
     expected_version = 190001
     version, raw = stream.read_alt_varint()
     if version != expected_version:
-        raise Exception('version of block {} is {} (raw: {}) but should be {}'.format(pos, version, raw, expected_version))
+        raise Exception('version of block {} is {} (raw: {}) but should be {}'.format(blockhash, version, raw, expected_version))
     data['version'] = version
 
     # height (alternative varint)
     height, raw = stream.read_alt_varint()
-    if height != pos:
-        raise Exception('height is {} (raw: {}) but should be {}'.format(height, raw, pos))
     data['height'] = height
 
     # status (alternative varint)
     status, raw = stream.read_alt_varint()
-    if DEBUG: print('block {}: status: {} (raw: {}, bin: {})'.format(pos, status, raw, bin(int(raw,16))))
+    if DEBUG: print('block {}: status: {} (raw: {}, bin: {})'.format(height, status, raw, bin(int(raw,16))))
     if status & (BLOCK_FAILED_VALID or BLOCK_FAILED_CHILD):
         raise Exception('block marked invalid: status is {} (raw: {})'.format(status, raw))
     data['status'] = status
@@ -291,6 +285,7 @@ for pos, blockhash in enumerate(blockhashes):
     bits_raw = stream.read_bytes(4, 'big')
     diff = bits_to_diff(bits_raw)
     if DEBUG: print('difficulty: {} (raw: {})'.format(diff, bits_raw))
+    data['bits'] = bits_raw
     data['difficulty'] = diff
 
     # nonce
@@ -303,32 +298,193 @@ for pos, blockhash in enumerate(blockhashes):
         stream.debug()
         raise Exception('data left in stream')
 
-    # append this block's index data to array
-    index.append(data)
-
-# close database
-db.close()
+    return data
 
-# Integrity check of index
-hash_prev_block_expected = '0'*64 # previous blockhash of genesis block
-for pos, item in enumerate(index):
+def decode_binary(blockhash, data):
+    # same as decode_hex(), but using the bytes-native decoder; the block's
+    # index data is converted to the same format at the very end
+    record = DiskBlockIndex.from_buffer(data)
 
-    # Assert that index and blockchain positions match
-    if (item['height'] != pos):
-        raise Exception('block height is {} but should be {}'.format(item['height'], pos))
+    expected_version = 190001
+    if record.version != expected_version:
+        raise Exception('version of block {} is {} but should be {}'.format(blockhash, record.version, expected_version))
+    if record.status & BLOCK_FAILED_VALID:
+        raise Exception('block marked invalid: status is {}'.format(record.status))
 
-    # Make sure prevbockhash in block matches index
-    if (item['hash_prev_block'] != hash_prev_block_expected):
-        raise Exception('previous block hash is {} but should be {}'.format(hash_prev_block, hash_prev_block_expected))
+    data = {}
+    data['blockhash'] = blockhash
+    data['version'] = record.version
+    data['height'] = record.height
+    data['status'] = record.status
+    data['ntx'] = record.ntx
+    if record.fileno is not None:
+        data['fileno'] = record.fileno
+    if record.datapos is not None:
+        data['datapos'] = record.datapos
+    if record.undopos is not None:
+        data['undopos'] = record.undopos
+    data['blockver'] = record.blockver
+    data['hash_prev_block'] = record.hash_prev_block[::-1].hex()
+    data['merkle_root'] = record.merkle_root[::-1].hex()
+    data['timestamp'] = '{:08x}'.format(record.timestamp)
+    data['bits'] = '{:08x}'.format(record.bits)
+    data['difficulty'] = bits_to_diff(data['bits'])
+    data['nonce'] = '{:08x}'.format(record.nonce)
+
+    if DEBUG: print('{} {}'.format(blockhash, data))
+
+    return data
+
+def decode(blockhash, data):
+    if DECODER == 'binary':
+        return decode_binary(blockhash, data)
+    return decode_hex(blockhash, data)
+
+def decode_chunk(records):
+    # decode a list of (key, value) pairs read from the block index; used by
+    # worker processes in scan mode
+    return [decode(endian(key[1:].hex(), 'big'), value) for key, value in records]
+
+def progress(pos, tip, start):
+    # determine performance (in hashes per second) based on empirical data
+    runtime = time.time() - start
+    hps = (pos+1)/runtime
+
+    # estimate remaining runtime by dividing remaining work through
+    # estimated performance
+    time_left = ((tip+1) - (pos+1))/hps
+
+    print('{}/{} (elapsed time {:.1f}s, remaining time: {:.1f}s)'.format(pos, tip, runtime, time_left))
+
+def read_index_get(db, blockhashes, start, first=0):
+    # locate raw blocks using the active chain's hashes in blockhashes, one
+    # LevelDB lookup per block, starting at height first
+    index = []
+    tip = len(blockhashes)
+    for pos in range(first, tip):
+        blockhash = blockhashes[pos]
+
+        # estimate remaining runtime
+        if (pos > 0 and pos % 10000 == 0):
+            progress(pos, tip, start)
+
+        blockhash_serialized = endian(blockhash, 'big')
+        data = decode(blockhash, db.get('b'.encode('ascii') + bytes.fromhex(blockhash_serialized)))
+        if data['height'] != pos:
+            raise Exception('height is {} but should be {}'.format(data['height'], pos))
+
+        # append this block's index data to array
+        index.append(data)
+
+    return index
+
+def read_index_scan(db, blockhashes, start, first=0):
+    # Iterate over all block index records (keys starting with 'b') once, in
+    # key order, instead of looking up each block hash. LevelDB stores
+    # records sorted by key, so this is a sequential read. Records of blocks
+    # not on the active chain (stale blocks, headers only) are skipped
+    # without decoding; the others are decoded by a pool of worker
+    # processes, and each one is put at the position given by its height,
+    # which must match the position of its hash in blockhashes. Only blocks
+    # starting at height first are decoded.
+    active = set(bytes.fromhex(endian(blockhash, 'big')) for blockhash in blockhashes[first:])
+    tip = len(blockhashes)
+
+    def chunks():
+        chunk = []
+        for key, value in db.iterator(prefix=b'b'):
+            if key[1:] not in active:
+                continue
+            chunk.append((key, value))
+            if len(chunk) == CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    index = [None] * (tip - first)
+    done = 0
+    with Pool(NUM_PROCESSES) as pool:
+        for decoded in pool.imap_unordered(decode_chunk, chunks()):
+            for data in decoded:
+                height = data['height']
+                if height < first or height >= tip or blockhashes[height] != data['blockhash']:
+                    raise Exception('block {} has height {}, which does not match its position in the active chain'.format(data['blockhash'], height))
+                index[height - first] = data
+            done += len(decoded)
+            progress(first + done, tip, start)
+
+    # make sure all blocks were found
+    if done != tip - first:
+        missing = [first + pos for pos, data in enumerate(index) if data is None]
+        raise Exception('{} blocks not found in block index, first missing block: {}'.format(len(missing), missing[0]))
+
+    return index
+
+if __name__ == '__main__':
+    # read array containing sorted block hashes of active chain
+    with open(blockhashdb, 'rb') as fp:
+            blockhashes = pickle.load(fp)
+
+    # keep the part of an existing index that is still on the active chain
+    index = []
+    if INCREMENTAL and os.path.exists(indexdb):
+        with open(indexdb, 'rb') as fp:
+                index = pickle.load(fp)
+    common = 0
+    while common < min(len(index), len(blockhashes)) and index[common]['blockhash'] == blockhashes[common]:
+        common += 1
+    if common < len(index):
+        print('dropping {} blocks of existing index no longer on active chain'.format(len(index) - common))
+    index = index[:common]
+    if common:
+        print('reusing {} blocks of existing index, decoding {} new blocks'.format(common, len(blockhashes) - common))
+
+    # open block index
+    db = plyvel.DB(datadir + '/blocks/index', compression=None)
+
+    # locate raw blocks using the active chain's hashes in blockhashes
+    start = time.time()
+    tip = len(blockhashes)
+    if MODE == 'scan' and tip - common >= CHUNK_SIZE:
+        index += read_index_scan(db, blockhashes, start, common)
     else:
-        hash_prev_block_expected = item['blockhash']
+        index += read_index_get(db, blockhashes, start, common)
+
+    # close database
+    db.close()
+
+    # Integrity check of index
+    hash_prev_block_expected = '0'*64 # previous blockhash of genesis block
+    for pos, item in enumerate(index):
 
-print('size of index: {}'.format(len(index)))
+        # Assert that index and blockchain positions match
+        if (item['height'] != pos):
+            raise Exception('block height is {} but should be {}'.format(item['height'], pos))
 
-# Write index to file
-db = 'blockindex.pdb'
-with open(db, 'wb') as fp:
-        pickle.dump(index, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        # Make sure prevbockhash in block matches index
+        if (item['hash_prev_block'] != hash_prev_block_expected):
+            raise Exception('previous block hash is {} but should be {}'.format(item['hash_prev_block'], hash_prev_block_expected))
+        else:
+            hash_prev_block_expected = item['blockhash']
+
+    print('size of index: {}'.format(len(index)))
+
+    # Write index to file
+    with open(indexdb, 'wb') as fp:
+            pickle.dump(index, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Write index in compact format used by parse_blockchain.py; the records
+    # of reused blocks are taken from the existing file if it matches
+    blockindex = BlockIndex.from_dicts(index[common:])
+    if common and os.path.exists(compactdb):
+        existing = BlockIndex.load(compactdb)
+        if len(existing) >= common and bytes(existing[common-1]['hash'])[::-1].hex() == blockhashes[common-1]:
+            blockindex = np.concatenate((existing[:common], blockindex))
+        else:
+            blockindex = BlockIndex.from_dicts(index)
+        del existing
+    BlockIndex.save(compactdb, blockindex)
 
-stop = time.time()
-print('wrote {} block hashes to {} in {:.1f}s'.format(tip+1, db, stop-start))
+    stop = time.time()
+    print('wrote {} block hashes to {} in {:.1f}s'.format(tip+1, indexdb, stop-start))
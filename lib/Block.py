@@ -1,7 +1,36 @@
 from .Transaction import Transaction
-from lib.tools import read_varint, bits_to_diff
+from .globals import utxo
+from .UTXO import utxo_entry
+from .Constants import TXOUT_TYPE
+from lib.tools import read_varint, read_varint_from, bits_to_diff, hash256_many
+import struct
 import time
 
+# block header: version, hash of previous block, merkle root, timestamp,
+# difficulty bits, nonce
+HEADER = struct.Struct('<I32s32sI4s4s')
+
+def spend_and_store(created, keys):
+    # Spend the UTXOs with keys (the outpoints spent by a block, in input
+    # order) and add the UTXOs created by the block (key -> unpacked UTXO set
+    # entry) to the UTXO set. UTXOs created earlier in the same block are
+    # resolved locally and never added to the UTXO set, the others are looked
+    # up in key order with a single call to utxo.update(), which also adds
+    # the block's remaining outputs. created is emptied in the process.
+    # Returns the entries of the spent UTXOs, in input order.
+    resolved = {}
+    external = []
+    for key in keys:
+        if key in created:
+            resolved[key] = created.pop(key)
+        else:
+            external.append(key)
+
+    # spend external UTXOs and store UTXOs that are still unspent
+    external.sort()
+    resolved.update(utxo.update(external, created))
+    return [resolved[key] for key in keys]
+
 class Block:
     def __init__(self, version, hash_prev_block, merkle_root, timestamp, diffbits, nonce, ntx, txs, size):
         self.version = version
@@ -20,6 +49,70 @@ class Block:
     def get_timestamp(self):
         return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.timestamp))
 
+    @staticmethod
+    def compute_txids(txs):
+        # calculate the txids of all of a block's transactions in one batch;
+        # the segments are views into the block, so they are released once
+        # hashed
+        txids = hash256_many([tx.txid_data for tx in txs])
+        for tx, txid in zip(txs, txids):
+            tx.txid = txid[::-1]
+            tx.txid_data = None
+
+    def detach(self):
+        # replace all views into the serialized block by copies, so the block
+        # can be pickled and no longer keeps the serialized data alive
+        for tx in self.transactions:
+            tx.detach()
+
+    def tx_sizes(self):
+        return [tx.size for tx in self.transactions]
+
+    def update_utxo(self):
+        # Spend the UTXOs referenced by the block's inputs and add its outputs
+        # to the UTXO set (see spend_and_store()). Returns one list of
+        # unpacked UTXO set entries per non-coinbase tx, in input order.
+
+        # UTXOs created in this block (except OP_RETURN)
+        created = {}
+        for tx in self.transactions:
+            for pos, output in enumerate(tx.outputs):
+                if output.created_UTXO_type != TXOUT_TYPE.OP_RETURN:
+                    created[tx.txid + pos.to_bytes(4, 'big')] = utxo_entry(output.amount, output.script_pubkey, output.created_UTXO_type)
+
+        # outpoints spent by the non-coinbase txs
+        keys = [inp.txid + inp.pos.to_bytes(4, 'big') for tx in self.transactions[1:] for inp in tx.inputs]
+        entries = spend_and_store(created, keys)
+
+        spent = []
+        pos = 0
+        for tx in self.transactions[1:]:
+            spent.append(entries[pos:pos+len(tx.inputs)])
+            pos += len(tx.inputs)
+        return spent
+
+    def connect(self, undo=None, spent=None):
+        # determine fees and spent UTXO types for all of the block's txs. If
+        # the block's undo data is provided (one list of spent coins per
+        # non-coinbase tx, see read_block_undo()), or the UTXO set entries of
+        # the spent coins in the same format as returned by update_utxo(),
+        # spent coins are taken from there and the UTXO set is neither used
+        # nor updated.
+        if spent is not None:
+            if len(spent) != len(self.transactions) - 1:
+                raise Exception('spent coins provided for {} txs, but block has {} non-coinbase txs'.format(len(spent), len(self.transactions) - 1))
+        elif undo is None:
+            spent = self.update_utxo()
+        else:
+            # undo data contains spent coins for all but the coinbase tx
+            if len(undo) != len(self.transactions) - 1:
+                raise Exception('undo data covers {} txs, but block has {} non-coinbase txs'.format(len(undo), len(self.transactions) - 1))
+            spent = [[coin.entry() for coin in coins] for coins in undo]
+
+        self.transactions[0].fee_and_type([])
+        for tx, entries in zip(self.transactions[1:], spent):
+            tx.fee_and_type(entries)
+
     @staticmethod
     def deserialize(stream):
         # deserialize one block
@@ -44,13 +137,56 @@ class Block:
         # deserialize transactions
         txs = []
         for i in range(ntx):
-            tx = Transaction.deserialize(stream)
-            # determine fee and spent UTXO type for tx's inputs
-            tx.fee_and_type()
-            txs.append(tx)
+            txs.append(Transaction.deserialize(stream))
+        Block.compute_txids(txs)
 
         # determine block size
         size = stream.tell() - pos_start
 
         # return a Block object
         return Block(version, hash_prev_block, merkle_root, timestamp, diffbits, nonce, ntx, txs, size)
+
+    @staticmethod
+    def header_from_buffer(buf, pos=0):
+        # decode the 80-byte block header at buf[pos] with the same
+        # conversions as in deserialize()
+        version, hash_prev_block, merkle_root, timestamp, diffbits, nonce = HEADER.unpack_from(buf, pos)
+        return version, hash_prev_block.hex()[::-1], merkle_root.hex()[::-1], timestamp, diffbits[::-1].hex(), nonce.hex()[::-1]
+
+    @staticmethod
+    def from_buffer(buf, pos=0, offsets=None, decoder=None):
+        # same as deserialize(), but reads from an in-memory buffer (e.g., a
+        # memoryview on a memory-mapped blk*.dat file) using explicit offsets
+        # instead of a stream. If the position of each tx in buf is known
+        # (offsets, see lib/TxOffsets.py), the txs are deserialized in chunks
+        # by decoder (see TxDecoder in lib/Pipeline.py); the block must end
+        # at the end of buf in this case.
+        buf = memoryview(buf)
+        pos_start = pos
+
+        # block header (80 bytes)
+        version, hash_prev_block, merkle_root, timestamp, diffbits, nonce = Block.header_from_buffer(buf, pos)
+        pos += 80
+
+        # number of transactions (varint)
+        ntx = buf[pos]
+        if ntx < 0xFD:
+            pos += 1
+        else:
+            ntx, pos = read_varint_from(buf, pos)
+
+        # deserialize transactions
+        if offsets is not None and decoder is not None:
+            if len(offsets) != ntx or offsets[0] != pos:
+                raise Exception('tx offsets do not match block with {} txs'.format(ntx))
+            txs = decoder.decode(buf, offsets, len(buf))
+            pos = len(buf)
+        else:
+            txs = []
+            for i in range(ntx):
+                tx, pos = Transaction.from_buffer(buf, pos)
+                txs.append(tx)
+            Block.compute_txids(txs)
+
+        # return a Block object
+        return Block(version, hash_prev_block, merkle_root, timestamp, diffbits, nonce, ntx, txs, pos - pos_start)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import pickle
+import numpy as np
+
+from .tools import hash256, bits_to_diff
+from .DiskBlockIndex import HEADER
+
+# Compact on-disk block index: one fixed-size record per block of the active
+# chain, stored in height order as a NumPy structured array (.npy file) that
+# is memory-mapped when loaded. Hashes and headers are stored as raw bytes in
+# the byte order used in the block chain (i.e., hashes are reversed compared
+# to their usual hex representation). fileno, datapos and undopos are -1 if
+# the block's data or undo data is not available.
+BLOCKINDEX_DTYPE = np.dtype([
+    ('height',  '<u4'),
+    ('status',  '<u4'),
+    ('ntx',     '<u4'),
+    ('fileno',  '<i4'),
+    ('datapos', '<i4'),
+    ('undopos', '<i4'),
+    ('hash',    'u1', 32),
+    ('header',  'u1', 80),
+])
+
+def diff_to_bits(diff):
+    # blockindex.pdb files created by earlier versions of create_index_db.py
+    # only contain the difficulty, not the difficulty bits. The bits can be
+    # recovered, because the target's mantissa (three bytes) is much shorter
+    # than a float's. bits_to_diff() calculates the difficulty the same way
+    # as create_index_db.py does.
+    target = int('00ffff', 16) * 2**(8*(int('1d', 16) - 3)) / diff
+    size = (int(target).bit_length() + 7) // 8
+    mantissa = round(target / 2**(8*(size-3)))
+    if mantissa & 0x800000:
+        mantissa = round(target / 2**(8*(size-2)))
+        size += 1
+    bits = '{:02x}{:06x}'.format(size, mantissa)
+    if bits_to_diff(bits) != diff:
+        raise Exception('cannot determine difficulty bits for difficulty {}'.format(diff))
+    return bits
+
+def from_dicts(index):
+    # convert index in the list-of-dicts format written to blockindex.pdb by
+    # create_index_db.py
+    blockindex = np.zeros(len(index), dtype=BLOCKINDEX_DTYPE)
+    for pos, block in enumerate(index):
+        record = blockindex[pos]
+        record['height'] = block['height']
+        record['status'] = block['status']
+        record['ntx'] = block['ntx']
+        record['fileno'] = block.get('fileno', -1)
+        record['datapos'] = block.get('datapos', -1)
+        record['undopos'] = block.get('undopos', -1)
+
+        # hashes are stored in reverse byte order in the dicts
+        blockhash = bytes.fromhex(block['blockhash'])[::-1]
+        bits = block['bits'] if 'bits' in block else diff_to_bits(block['difficulty'])
+        header = HEADER.pack(block['blockver'],
+                             bytes.fromhex(block['hash_prev_block'])[::-1],
+                             bytes.fromhex(block['merkle_root'])[::-1],
+                             int(block['timestamp'], 16),
+                             int(bits, 16),
+                             int(block['nonce'], 16))
+
+        # make sure the header was reconstructed correctly
+        if hash256(header) != blockhash:
+            raise Exception('header of block {} does not match block hash {}'.format(pos, block['blockhash']))
+
+        record['hash'] = np.frombuffer(blockhash, dtype=np.uint8)
+        record['header'] = np.frombuffer(header, dtype=np.uint8)
+    return blockindex
+
+def save(filename, blockindex):
+    np.save(filename, blockindex, allow_pickle=False)
+
+def load(filename):
+    # load a block index, either in compact format (memory-mapped, read only)
+    # or from a blockindex.pdb file (converted in memory)
+    if filename.endswith('.pdb'):
+        with open(filename, 'rb') as fp:
+            return from_dicts(pickle.load(fp))
+    return np.load(filename, mmap_mode='r', allow_pickle=False)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import mmap
+import numpy as np
+
+# there's a magic number, 0xD9B4BEF9, at the beginning of each block in the
+# block chain format used by bitcoin core
+MAGIC = bytes.fromhex('d9b4bef9')
+
+class BufferStream:
+    # Minimal file-like object on top of an in-memory buffer. read() returns
+    # memoryview slices into the buffer instead of copies, so deserializing a
+    # block from a memory-mapped file does not allocate a new bytes object
+    # for every field.
+
+    __slots__ = ['buf', 'pos']
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.pos = 0
+
+    def read(self, nbytes):
+        data = self.buf[self.pos:self.pos+nbytes]
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        else:
+            self.pos = len(self.buf) + offset
+        return self.pos
+
+class BlockReader:
+    # Read raw blocks from Bitcoin Core's blk*.dat files using regular
+    # buffered file objects
+
+    def __init__(self, datadir, max_open=8):
+        self.datadir = datadir
+        self.max_open = max_open
+        self.files = {} # dict for file handles
+        self.opened = set() # numbers of all files opened so far
+        self.reopened = 0   # number of times a file had to be opened again
+
+    def filename(self, fileno, prefix='blk'):
+        # blocks are stored in blk*.dat, undo data in rev*.dat
+        return self.datadir + '/blocks/{}{:05}.dat'.format(prefix, fileno)
+
+    def open(self, filename):
+        # Use a ten-megabyte buffer
+        return open(filename, 'rb', 10*1024*1024)
+
+    def release(self, handle):
+        handle.close()
+
+    def get(self, fileno, prefix='blk'):
+        # Put a limit on the number of open files (eight by default)
+        # Check if file already open using dict. if not, open it, put handle in dict
+        filename = self.filename(fileno, prefix)
+        if filename in self.files:
+            return self.files[filename]
+
+        # Make sure there are a maximum of max_open open files
+        # To this end, discard smallest first item in dict, which corresponds
+        # to the oldest one (Python >=3.7 has ordered dicts)
+        if len(self.files) == self.max_open:
+            remove = next(iter(self.files))
+            self.release(self.files.pop(remove))
+        if filename in self.opened:
+            self.reopened += 1
+        self.opened.add(filename)
+        handle = self.open(filename)
+        self.files[filename] = handle
+        return handle
+
+    def read(self, fileno, datapos, prefix='blk'):
+        # return the serialized block stored at datapos in blk<fileno>.dat
+        f = self.get(fileno, prefix)
+
+        # datapos points to block header, we rewind by two times four bytes to
+        # make it point to magic (four bytes), block size (four bytes), block
+        # header
+        f.seek(datapos-8)
+
+        # read four bytes magic
+        magic = f.read(4)[::-1]
+        if magic != MAGIC:
+            raise Exception('Error: Block magic not found! (read {}, should be {})'.format(magic, MAGIC))
+
+        # read four-byte integer corresponding to the block size
+        blocksize = int.from_bytes(f.read(4), 'little')
+        return f.read(blocksize)
+
+    def read_undo(self, fileno, undopos):
+        # return the block undo data stored at undopos in rev<fileno>.dat; it
+        # is framed the same way as blocks (magic, size, data) and followed by
+        # a 32-byte checksum, which is not returned
+        return self.read(fileno, undopos, 'rev')
+
+    def close(self):
+        for handle in self.files.values():
+            self.release(handle)
+        self.files.clear()
+
+class MmapBlockReader(BlockReader):
+    # Memory-map blk*.dat files and return memoryview slices covering exactly
+    # one block. Nothing is copied until the parser converts a slice to bytes.
+
+    def open(self, filename):
+        # the mapping keeps its own reference to the file, so the file object
+        # can be closed right away
+        with open(filename, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def release(self, handle):
+        # Blocks handed out earlier may still hold views into the mapping, in
+        # which case mmap.close() would fail. Dropping our reference is
+        # sufficient: the file is unmapped once the last view is released.
+        pass
+
+    def read(self, fileno, datapos, prefix='blk'):
+        m = self.get(fileno, prefix)
+
+        # read four bytes magic
+        magic = m[datapos-8:datapos-4][::-1]
+        if magic != MAGIC:
+            raise Exception('Error: Block magic not found! (read {}, should be {})'.format(magic, MAGIC))
+
+        # read four-byte integer corresponding to the block size
+        blocksize = int.from_bytes(m[datapos-4:datapos], 'little')
+        if datapos + blocksize > len(m):
+            raise Exception('Error: block at position {} in file {} exceeds file size'.format(datapos, fileno))
+
+        return memoryview(m)[datapos:datapos+blocksize]
+
+def read_undo(reader, block):
+    # read undo data of a block, if there is any (i.e., for all but the
+    # genesis block)
+    if block['undopos'] < 0:
+        return None
+    return reader.read_undo(int(block['fileno']), int(block['undopos']))
+
+def read_blocks(reader, blockindex, undo=False, start=0):
+    # read all blocks in blockindex in height order, starting at height start;
+    # yield height, serialized block and, if undo is set, the block's undo data
+    # (None otherwise)
+    for height in range(start, len(blockindex)):
+        block = blockindex[height]
+        yield height, reader.read(int(block['fileno']), int(block['datapos'])), read_undo(reader, block) if undo else None
+
+class SequentialScheduler:
+    # Blocks in blk*.dat files are stored in the order they arrived, not in
+    # height order, so reading them in height order jumps back and forth
+    # between (and within) files. The scheduler instead reads each file
+    # strictly sequentially, files ordered by the lowest height they contain,
+    # and keeps blocks that arrive early in a reorder buffer until all blocks
+    # before them have been delivered. Iterating over the scheduler yields
+    # height, serialized block and undo data in height order, like
+    # read_blocks(); undo data is read along with each block if undo is set.
+    #
+    # The reorder buffer holds at most capacity blocks and max_bytes bytes of
+    # blocks and undo data. If it is full, the next block in height order is
+    # read directly (out of file order), which is counted in direct_reads.
+    # Blocks below height start are skipped.
+
+    def __init__(self, reader, blockindex, capacity=1024, undo=False, start=0, max_bytes=256*1024*1024):
+        self.reader = reader
+        self.blockindex = blockindex
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.undo = undo
+        self.start = start
+        self.buffer = {}            # reorder buffer: height -> serialized block and undo data
+        self.bytes = 0              # size of blocks and undo data in reorder buffer [B]
+        self.max_occupancy = 0      # maximum number of blocks in reorder buffer
+        self.max_bytes_used = 0     # maximum size of reorder buffer [B]
+        self.direct_reads = 0       # number of blocks read out of file order
+
+        # group blocks by file, sort each file's blocks by position, and sort
+        # files by the lowest height they contain
+        files = {}
+        order = np.lexsort((blockindex['datapos'], blockindex['fileno']))
+        for height, fileno, datapos in zip(order.tolist(), blockindex['fileno'][order].tolist(), blockindex['datapos'][order].tolist()):
+            if height >= start:
+                files.setdefault(fileno, []).append((datapos, height))
+        self.schedule = sorted(files.items(), key=lambda item: min(height for _, height in item[1]))
+
+    def read(self, height):
+        # read block and, if requested, its undo data
+        block = self.blockindex[height]
+        return self.reader.read(int(block['fileno']), int(block['datapos'])), read_undo(self.reader, block) if self.undo else None
+
+    def release(self, height):
+        # remove a block from the reorder buffer
+        raw, raw_undo = self.buffer.pop(height)
+        self.bytes -= len(raw) + (len(raw_undo) if raw_undo is not None else 0)
+        return height, raw, raw_undo
+
+    def __iter__(self):
+        next_height = self.start
+        for fileno, blocks in self.schedule:
+            for datapos, height in blocks:
+                # skip blocks that were already read directly
+                if height < next_height:
+                    continue
+
+                raw, raw_undo = self.buffer[height] = self.read(height)
+                self.bytes += len(raw) + (len(raw_undo) if raw_undo is not None else 0)
+                self.max_occupancy = max(self.max_occupancy, len(self.buffer))
+                self.max_bytes_used = max(self.max_bytes_used, self.bytes)
+
+                # release all blocks that are next in height order
+                while next_height in self.buffer:
+                    yield self.release(next_height)
+                    next_height += 1
+
+                # if the buffer is full, read the block we are waiting for
+                # directly
+                while self.buffer and (len(self.buffer) >= self.capacity or self.bytes > self.max_bytes):
+                    self.direct_reads += 1
+                    yield (next_height, *self.read(next_height))
+                    next_height += 1
+                    while next_height in self.buffer:
+                        yield self.release(next_height)
+                        next_height += 1
+
+        # all blocks are released after the last file has been read
+        if self.buffer or next_height != len(self.blockindex):
+            raise Exception('reorder buffer not empty after reading all files: delivered {} of {} blocks'.format(next_height, len(self.blockindex)))
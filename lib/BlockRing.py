@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import queue
+import traceback
+import multiprocessing
+import numpy as np
+from collections import deque
+from multiprocessing import shared_memory
+
+from .Block import Block, spend_and_store
+from .Output import spent_type_solver
+from .Witness import Witness
+from .Script import Script
+from .Constants import TXOUT_TYPE
+from .Pipeline import decode
+from .UTXO import utxo_entry
+from .tools import varint_size
+
+# Decoded blocks are passed from the worker processes to the consumer through
+# one ring buffer in shared memory per worker instead of being pickled. Each
+# record in a ring buffer consists of the serialized block, followed by its
+# txids (32 bytes each, in the usual byte order) and tables holding what the
+# statistics need to know about each tx, input and output: sizes, amounts,
+# the created UTXO type and UTXO set entry (see lib/UTXO.py) of each output,
+# the outpoint spent by each input and where its script_sig, witness items
+# and each output's script_pubkey are in the serialized block. With undo data, the UTXO set entries of the
+# UTXOs spent by the block follow. The worker decodes the block as usual (see
+# decode() in lib/Pipeline.py) and derives the tables from the result (see
+# tables()); the consumer reads the tables in place (see BlockTables) instead
+# of putting Transaction objects together again.
+TX_DTYPE = np.dtype([
+    ('size',            '<u4'),
+    ('stripped_size',   '<u4'),
+    ('inputs',          '<u4'),     # number of inputs
+    ('outputs',         '<u4'),     # number of outputs
+])
+INPUT_DTYPE = np.dtype([
+    ('txid',            'V32'),     # spent outpoint, txid in the usual byte order
+    ('pos',             '<u4'),
+    ('size',            '<u4'),
+    ('script_start',    '<u4'),
+    ('script_size',     '<u4'),
+    ('witness_size',    '<u4'),     # 0 if there's no witness
+    ('witness_items',   '<u4'),
+])
+ITEM_DTYPE = np.dtype([
+    ('start',           '<u4'),
+    ('size',            '<u4'),
+])
+# the first five fields are the output's UTXO set entry
+OUTPUT_DTYPE = np.dtype([
+    ('amount',          '<u8'),
+    ('type',            'u1'),      # created UTXO type
+    ('script_size',     '<u4'),
+    ('m',               'u1'),
+    ('n',               'u1'),
+    ('size',            '<u4'),
+    ('script_start',    '<u4'),
+])
+SPENT_DTYPE = np.dtype([
+    ('amount',          '<u8'),
+    ('type',            'u1'),
+    ('script_size',     '<u4'),
+    ('m',               'u1'),
+    ('n',               'u1'),
+])
+ENTRY_FIELDS = ['amount', 'type', 'script_size', 'm', 'n']
+
+# created UTXO types by value
+TXOUT_TYPES = {txout_type.value: txout_type for txout_type in TXOUT_TYPE}
+
+def tables(b):
+    # note what the statistics need about each tx, input and output of a
+    # decoded block and where each script_sig, witness item and script_pubkey
+    # is in the serialized block; the positions follow from the sizes of the parts and
+    # the varints in between, so the block doesn't need to be walked again.
+    # Returns the tables (as lists of tuples, see the dtypes above) and the
+    # txids.
+    txs = []
+    inputs = []
+    items = []
+    outputs = []
+    pos = 80 + varint_size(b.ntx)
+    for tx in b.transactions:
+        start = pos
+        pos += 4 + (2 if tx.is_segwit else 0) + varint_size(len(tx.inputs))
+        first_input = len(inputs)
+        for inp in tx.inputs:
+            script_size = inp.script_sig.size()
+            inputs.append([inp.txid, inp.pos, inp.size, pos + 36 + varint_size(script_size), script_size, 0, 0])
+            pos += inp.size
+        pos += varint_size(len(tx.outputs))
+        for output in tx.outputs:
+            script_start = pos + 8 + varint_size(output.script_pubkey.size())
+            outputs.append(utxo_entry(output.amount, output.script_pubkey, output.created_UTXO_type) + (output.size, script_start))
+            pos += output.size
+
+        # witnesses of all inputs; an empty witness is a single zero byte
+        if tx.is_segwit:
+            for inp, row in zip(tx.inputs, inputs[first_input:]):
+                if inp.witness is None:
+                    pos += 1
+                    continue
+                row[5] = inp.witness.size
+                row[6] = len(inp.witness.items)
+                pos += varint_size(len(inp.witness.items))
+                for item in inp.witness.items:
+                    pos += varint_size(len(item))
+                    items.append((pos, len(item)))
+                    pos += len(item)
+
+        # lock time
+        pos += 4
+        if pos - start != tx.size:
+            raise Exception('tx {} has {} bytes, but its parts add up to {}'.format(tx.txid.hex(), tx.size, pos - start))
+        txs.append((tx.size, tx.stripped_size, len(tx.inputs), len(tx.outputs)))
+
+    txids = b''.join(tx.txid for tx in b.transactions)
+    return txs, [tuple(inp) for inp in inputs], items, outputs, txids
+
+def offsets(counts):
+    # position of the first element belonging to each of a number of
+    # consecutive groups with counts elements, followed by the total
+    return np.concatenate(([0], np.cumsum(counts, dtype=np.int64))).tolist()
+
+def sums(values, starts):
+    # sum of the values in each group starting at starts (see offsets())
+    total = np.zeros(len(values) + 1, np.uint64)
+    np.cumsum(values, dtype=np.uint64, out=total[1:])
+    return (total[starts[1:]] - total[starts[:-1]]).tolist()
+
+class TxView:
+    # a tx of a BlockTables, with the attributes of a Transaction the
+    # statistics (see lib/statistics.py) use
+    __slots__ = ['inputs', 'outputs', 'size', 'stripped_size', 'weight', 'is_segwit', 'fee']
+
+    def __init__(self, inputs, outputs, size, stripped_size, fee):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.size = size
+        self.stripped_size = stripped_size
+        self.weight = stripped_size * 4 + (size - stripped_size)
+        # only segwit txs have a marker, flag and witnesses
+        self.is_segwit = size != stripped_size
+        self.fee = fee
+
+class InputView:
+    # an input of a BlockTables, with the attributes of an Input the
+    # statistics use
+    __slots__ = ['script_sig', 'witness', 'size', 'spent_UTXO_type', 'spent_UTXO_size', 'spent_UTXO_multisig']
+
+    def __init__(self, script_sig, witness, size, spent_UTXO_type, spent_UTXO_size, spent_UTXO_multisig):
+        self.script_sig = script_sig
+        self.witness = witness
+        self.size = size
+        self.spent_UTXO_type = spent_UTXO_type
+        self.spent_UTXO_size = spent_UTXO_size
+        self.spent_UTXO_multisig = spent_UTXO_multisig
+
+class OutputView:
+    # an output of a BlockTables, with the attributes of an Output the
+    # statistics use
+    __slots__ = ['amount', 'script_pubkey', 'created_UTXO_type', 'size']
+
+    def __init__(self, amount, script_pubkey, created_UTXO_type, size):
+        self.amount = amount
+        self.script_pubkey = script_pubkey
+        self.created_UTXO_type = created_UTXO_type
+        self.size = size
+
+class BlockTables:
+    # A block received through a ring buffer: the header fields and the
+    # tables of a record (see the dtypes above), which are views into the
+    # ring buffer. Block.connect() reads amounts and types from the tables;
+    # script_sigs and witnesses are only put together for the inputs that
+    # need them (see script_sig() and witness()). Once connected, the block
+    # has a list of transactions (see TxView), so the statistics treat it
+    # like a Block; their scripts are views into the ring buffer as well.
+
+    def __init__(self, raw, txids, txs, inputs, items, outputs):
+        self.version, self.prev_hash, self.merkle_root, self.timestamp, self.diffbits, self.nonce = Block.header_from_buffer(raw)
+        self.raw = raw
+        self.size = len(raw)
+        self.ntx = len(txs)
+        self.txids = txids
+        self.txs = txs
+        self.inputs = inputs
+        self.items = items
+        self.outputs = outputs
+        # first input and output of each tx and first witness item of each
+        # input, each followed by the total
+        self.first_input = offsets(txs['inputs'])
+        self.first_output = offsets(txs['outputs'])
+        self.first_item = offsets(inputs['witness_items'])
+        # set by connect(): fee of each tx, spent UTXO type of each input
+        # (all inputs), entries of the spent UTXOs (non-coinbase inputs) and
+        # the txs (see views())
+        self.fees = None
+        self.spent_types = None
+        self.spent = None
+        self.transactions = None
+
+    get_diff = Block.get_diff
+    get_timestamp = Block.get_timestamp
+
+    def tx_sizes(self):
+        return self.txs['size'].tolist()
+
+    def outputs_amount(self):
+        # amount of all outputs of each tx
+        return sums(self.outputs['amount'], np.array(self.first_output))
+
+    def script_sig(self, i):
+        # script_sig of input i (counting all of the block's inputs)
+        start = int(self.inputs['script_start'][i])
+        return Script(self.raw[start:start+int(self.inputs['script_size'][i])])
+
+    def witness(self, i):
+        # witness of input i, None if it has none
+        if self.inputs['witness_items'][i] == 0:
+            return None
+        items = self.items[self.first_item[i]:self.first_item[i+1]].tolist()
+        return Witness([self.raw[start:start+size] for start, size in items], int(self.inputs['witness_size'][i]))
+
+    def update_utxo(self):
+        # same as Block.update_utxo(), but returns the entries of the spent
+        # UTXOs as a single table
+        created = {}
+        types = self.outputs['type'].tolist()
+        entries = self.outputs[ENTRY_FIELDS].tolist()
+        for i in range(self.ntx):
+            txid = self.txids[32*i:32*i+32]
+            for pos, output in enumerate(range(self.first_output[i], self.first_output[i+1])):
+                if types[output] != TXOUT_TYPE.OP_RETURN.value:
+                    created[txid + pos.to_bytes(4, 'big')] = entries[output]
+
+        coinbase_inputs = self.first_input[1]
+        keys = [txid + pos.to_bytes(4, 'big') for txid, pos in zip(self.inputs['txid'][coinbase_inputs:].tolist(), self.inputs['pos'][coinbase_inputs:].tolist())]
+        return np.array(spend_and_store(created, keys), SPENT_DTYPE)
+
+    def connect(self, spent=None):
+        # determine fees and spent UTXO types (see Block.connect()); spent
+        # holds the entries of the UTXOs spent by the non-coinbase inputs, as
+        # received along with the block, otherwise the UTXO set is used
+        coinbase_inputs = self.first_input[1]
+        if spent is None:
+            spent = self.update_utxo()
+        elif len(spent) != len(self.inputs) - coinbase_inputs:
+            raise Exception('spent coins provided for {} inputs, but block has {} non-coinbase inputs'.format(len(spent), len(self.inputs) - coinbase_inputs))
+        self.spent = spent
+
+        # spent UTXO types: P2SH and P2WSH spends depend on the script_sig
+        # and witness (see spent_type_solver())
+        spent_types = [TXOUT_TYPE.COINBASE] * coinbase_inputs
+        for i, created_UTXO_type in enumerate(spent['type'].tolist(), coinbase_inputs):
+            if created_UTXO_type == TXOUT_TYPE.P2SH.value or created_UTXO_type == TXOUT_TYPE.P2WSH.value:
+                spent_types.append(spent_type_solver(TXOUT_TYPES[created_UTXO_type], script_sig=self.script_sig(i), witness=self.witness(i)))
+            else:
+                spent_types.append(TXOUT_TYPES[created_UTXO_type])
+        self.spent_types = spent_types
+
+        # fees: amount of the spent UTXOs minus amount of the outputs
+        first_spent = np.array(self.first_input[1:]) - coinbase_inputs
+        inputs_amount = sums(spent['amount'], first_spent)
+        self.fees = [0] + [i - o for i, o in zip(inputs_amount, self.outputs_amount()[1:])]
+        self.transactions = self.views()
+
+    def views(self):
+        # the txs with their inputs and outputs (see TxView), built from the
+        # tables and what connect() determined
+        coinbase_inputs = self.first_input[1]
+        raw = self.raw
+        inputs = []
+        spent_sizes = [0] * coinbase_inputs + self.spent['script_size'].tolist()
+        multisig = [(0, 0)] * coinbase_inputs + self.spent[['m', 'n']].tolist()
+        rows = self.inputs[['size', 'script_start', 'script_size', 'witness_items']].tolist()
+        for i, (size, start, script_size, witness_items) in enumerate(rows):
+            witness = self.witness(i) if witness_items > 0 else None
+            inputs.append(InputView(Script(raw[start:start+script_size]), witness, size, self.spent_types[i], spent_sizes[i], multisig[i]))
+        outputs = [OutputView(amount, Script(raw[start:start+script_size]), TXOUT_TYPES[created_UTXO_type], size)
+                   for amount, created_UTXO_type, script_size, size, start in self.outputs[['amount', 'type', 'script_size', 'size', 'script_start']].tolist()]
+
+        transactions = []
+        for i, (size, stripped_size) in enumerate(self.txs[['size', 'stripped_size']].tolist()):
+            transactions.append(TxView(inputs[self.first_input[i]:self.first_input[i+1]], outputs[self.first_output[i]:self.first_output[i+1]], size, stripped_size, self.fees[i]))
+        return transactions
+
+def encode(height, raw, raw_undo, parser, undo):
+    # decode a block (and its undo data) into the arrays making up a record;
+    # returns the arrays and the counts needed to find them again
+    height, b, spent = decode(height, raw, raw_undo, parser, undo)
+    txs, inputs, items, outputs, txids = tables(b)
+    arrays = [np.frombuffer(raw, np.uint8), np.frombuffer(txids, np.uint8),
+              np.array(txs, TX_DTYPE), np.array(inputs, INPUT_DTYPE),
+              np.array(items, ITEM_DTYPE), np.array(outputs, OUTPUT_DTYPE)]
+    num_spent = -1
+    if undo:
+        spent = [entry for entries in spent for entry in entries]
+        arrays.append(np.array(spent, SPENT_DTYPE))
+        num_spent = len(spent)
+    return arrays, (len(raw), len(txs), len(inputs), len(items), len(outputs), num_spent)
+
+def receive(buf, offset, counts):
+    # the block in the record at buf[offset] and the entries of the UTXOs it
+    # spends (None if the record has none)
+    raw_size, ntx, num_inputs, num_items, num_outputs, num_spent = counts
+    raw = buf[offset:offset+raw_size]
+    pos = offset + raw_size
+    txids = bytes(buf[pos:pos+32*ntx])
+    pos += 32*ntx
+    txs = np.frombuffer(buf, TX_DTYPE, ntx, pos)
+    pos += TX_DTYPE.itemsize * ntx
+    inputs = np.frombuffer(buf, INPUT_DTYPE, num_inputs, pos)
+    pos += INPUT_DTYPE.itemsize * num_inputs
+    items = np.frombuffer(buf, ITEM_DTYPE, num_items, pos)
+    pos += ITEM_DTYPE.itemsize * num_items
+    outputs = np.frombuffer(buf, OUTPUT_DTYPE, num_outputs, pos)
+    pos += OUTPUT_DTYPE.itemsize * num_outputs
+    spent = np.frombuffer(buf, SPENT_DTYPE, num_spent, pos) if num_spent >= 0 else None
+    return BlockTables(raw, txids, txs, inputs, items, outputs), spent
+
+def work(name, capacity, tasks, results, parser, undo):
+    # executed in a worker process: decode the batches of blocks received in
+    # tasks and write them to the ring buffer in shared memory segment name.
+    # The consumer is told where each record is (in results) and, once done
+    # with it, how far the ring buffer may be overwritten (in tasks).
+    ring = shared_memory.SharedMemory(name=name)
+    try:
+        fill(ring.buf, capacity, tasks, results, parser, undo)
+    except Exception:
+        results.put(traceback.format_exc())
+    ring.close()
+
+def fill(buf, capacity, tasks, results, parser, undo):
+    head = 0            # number of bytes written to the ring buffer so far
+    tail = 0            # number of bytes released by the consumer so far
+    batches = deque()   # batches received, but not yet decoded
+
+    def receive():
+        # handle one message; returns False once told to stop
+        nonlocal tail
+        message = tasks.get()
+        if message is None:
+            return False
+        if message[0] == 'release':
+            tail = message[1]
+        else:
+            batches.append(message[1])
+        return True
+
+    while True:
+        if not batches and not receive():
+            return
+        if not batches:
+            continue
+        records = []    # locations of records not yet sent to the consumer
+        for height, raw, raw_undo in batches.popleft():
+            arrays, counts = encode(height, raw, raw_undo, parser, undo)
+            size = sum(array.nbytes for array in arrays)
+            if size > capacity:
+                raise Exception('block {} needs {} bytes, but the ring buffer only has {}'.format(height, size, capacity))
+
+            # records are never split: skip the end of the ring buffer if the
+            # record doesn't fit there
+            offset = head % capacity
+            if offset + size > capacity:
+                head += capacity - offset
+                offset = 0
+
+            # wait for the consumer to release enough space; it can only do
+            # so for records it knows about
+            while head + size - tail > capacity:
+                if records:
+                    results.put(records)
+                    records = []
+                if not receive():
+                    return
+
+            start = offset
+            for array in arrays:
+                buf[offset:offset+array.nbytes] = array.view(np.uint8)
+                offset += array.nbytes
+            head += size
+            records.append((height, start, head, counts))
+        results.put(records)
+
+class RingDecodePool:
+    # Same as DecodePool (see lib/Pipeline.py), but decoded blocks are
+    # returned through ring buffers in shared memory (see work()) as
+    # BlockTables instead of being pickled. Batch i is decoded by worker i
+    # modulo the number of workers, so the blocks can be collected in order.
+    # Each worker's ring buffer has capacity bytes, which must be enough for
+    # the largest block.
+    #
+    # A block's tables are views into the ring buffer: they are valid until
+    # the next block is requested. Workers are forked, like DecodePool's.
+
+    def __init__(self, processes=None, depth=None, batch_bytes=4*1024*1024, capacity=64*1024*1024, parser='buffer', undo=False):
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.depth = depth if depth is not None else 2 * self.processes
+        self.batch_bytes = batch_bytes
+        self.capacity = capacity
+        self.batches = 0            # number of batches sent to workers
+        self.max_pending = 0        # maximum number of batches in flight
+        self.blocks = 0             # number of blocks received
+        self.block_bytes = 0        # size of serialized blocks received [B]
+        self.ring_bytes = 0         # size of records received [B]
+        self.copied = 0             # bytes copied in this process (see map() and collect())
+        self.wait = 0               # time spent waiting for workers [s]
+        self.start = None
+        self.ring_end = [0] * self.processes    # end of last record received from each worker
+
+        self.rings = []
+        self.tasks = []
+        self.results = []
+        self.received = []          # records received from each worker
+        self.workers = []
+        self.closed = False
+        context = multiprocessing.get_context('fork')
+        try:
+            for i in range(self.processes):
+                ring = shared_memory.SharedMemory(create=True, size=capacity)
+                self.rings.append(ring)
+                tasks = context.Queue()
+                results = context.Queue()
+                worker = context.Process(target=work, args=(ring.name, capacity, tasks, results, parser, undo), daemon=True)
+                worker.start()
+                self.tasks.append(tasks)
+                self.results.append(results)
+                self.received.append(deque())
+                self.workers.append(worker)
+        except BaseException:
+            self.close(terminate=True)
+            raise
+
+    def submit(self, pending, batch):
+        worker = self.batches % self.processes
+        self.tasks[worker].put(('decode', batch))
+        pending.append((worker, len(batch)))
+        self.batches += 1
+        self.max_pending = max(self.max_pending, len(pending))
+
+    def wait_for(self, worker):
+        # wait for the next records from worker; a worker that died without
+        # reporting an error (e.g. killed for running out of memory) would
+        # otherwise leave us waiting forever
+        start = time.time()
+        while True:
+            try:
+                records = self.results[worker].get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.workers[worker].is_alive():
+                    raise Exception('decoding worker {} exited with code {}'.format(worker, self.workers[worker].exitcode))
+        self.wait += time.time() - start
+        if isinstance(records, str):
+            raise Exception('error in decoding worker {}:\n{}'.format(worker, records))
+        return records
+
+    def collect(self, worker, count):
+        # yield the next count blocks decoded by worker; each block's record
+        # is released when the next one is requested
+        received = self.received[worker]
+        buf = self.rings[worker].buf
+        for i in range(count):
+            if not received:
+                received.extend(self.wait_for(worker))
+            height, offset, end, counts = received.popleft()
+            b, spent = receive(buf, offset, counts)
+            # the txids are copied out of the record (see receive())
+            self.copied += len(b.txids)
+            self.blocks += 1
+            self.block_bytes += counts[0]
+            self.ring_bytes += end - self.ring_end[worker]
+            self.ring_end[worker] = end
+            yield height, b, spent
+            b = spent = None
+            self.tasks[worker].put(('release', end))
+
+    def map(self, blocks):
+        # decode blocks (see decode_blocks() in lib/Pipeline.py) in the worker
+        # processes
+        self.start = time.time()
+        try:
+            pending = deque()
+            batch = []
+            size = 0
+            for height, raw, raw_undo in blocks:
+                # views into memory-mapped files cannot be pickled
+                if isinstance(raw, memoryview):
+                    raw = bytes(raw)
+                    self.copied += len(raw)
+                if isinstance(raw_undo, memoryview):
+                    raw_undo = bytes(raw_undo)
+                    self.copied += len(raw_undo)
+                batch.append((height, raw, raw_undo))
+                size += len(raw)
+                if size < self.batch_bytes:
+                    continue
+                self.submit(pending, batch)
+                batch = []
+                size = 0
+                # wait for the oldest batch if too many are in flight
+                while len(pending) >= self.depth:
+                    yield from self.collect(*pending.popleft())
+            if batch:
+                self.submit(pending, batch)
+            while pending:
+                yield from self.collect(*pending.popleft())
+        except BaseException:
+            # don't leave the ring buffers behind if anything goes wrong
+            # (including the consumer stopping early)
+            self.close(terminate=True)
+            raise
+
+    def stats(self):
+        elapsed = time.time() - self.start if self.start is not None else 0
+        blocks = max(self.blocks, 1)
+        return 'ring buffers: {} blocks, {:.1f}MB of blocks in {:.1f}MB of records ({:.1f}MB/s), {:.0f} bytes per block copied in this process, waited {:.1f}s for workers'.format(
+            self.blocks, self.block_bytes / 1024**2, self.ring_bytes / 1024**2, self.ring_bytes / 1024**2 / elapsed if elapsed > 0 else 0, self.copied / blocks, self.wait)
+
+    def close(self, terminate=False):
+        # stop the workers, or kill them with terminate, and remove the ring
+        # buffers, which would otherwise outlive this process
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            for tasks, worker in zip(self.tasks, self.workers):
+                if terminate:
+                    worker.terminate()
+                else:
+                    tasks.put(None)
+            for worker in self.workers:
+                worker.join()
+        finally:
+            for ring in self.rings:
+                ring.unlink()
+                # views of the last blocks may still exist, in which case the
+                # mapping is only released along with them
+                try:
+                    ring.close()
+                except BufferError:
+                    pass
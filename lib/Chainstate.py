@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import plyvel
+
+from .Coin import Coin
+from .tools import read_core_varint
+
+# Bitcoin Core's UTXO set database (chainstate/, see src/txdb.cpp): coins are
+# stored under 'C' + txid + VARINT(output position), the hash of the block up
+# to which the database is current under 'B'. All values are XORed with the
+# obfuscation key stored under '\x0e\x00obfuscate_key'.
+DB_COIN = b'C'
+DB_BEST_BLOCK = b'B'
+OBFUSCATE_KEY_KEY = b'\x0e\x00obfuscate_key'
+
+def obfuscation_key(db):
+    # the key is stored as a vector: length (one byte) followed by the key
+    value = db.get(OBFUSCATE_KEY_KEY)
+    if value is None:
+        return b''
+    return value[1:1+value[0]]
+
+def deobfuscate(value, key):
+    if not key:
+        return value
+    size = len(value)
+    stream = (key * (size // len(key) + 1))[:size]
+    return (int.from_bytes(value, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(size, 'little')
+
+def load(path, utxo, coins=True):
+    # add all coins in the chainstate database in path to utxo (unless coins
+    # is False); returns the hash of the chainstate's best block (in the byte
+    # order used in the block chain) and the number of coins. bitcoind must
+    # not be running.
+    db = plyvel.DB(path, compression=None)
+    key = obfuscation_key(db)
+    best_block = db.get(DB_BEST_BLOCK)
+    if best_block is None:
+        raise Exception('no best block in chainstate {}'.format(path))
+    best_block = deobfuscate(best_block, key)
+
+    count = 0
+    for dbkey, value in db.iterator(prefix=DB_COIN) if coins else []:
+        # txid is stored in internal byte order, UTXO set keys use the
+        # reverse (see Block.compute_txids())
+        pos, end = read_core_varint(dbkey, 33)
+        if end != len(dbkey):
+            raise Exception('malformed coin key {} in chainstate'.format(dbkey.hex()))
+        value = deobfuscate(value, key)
+        coin, end = Coin.from_buffer(value, 0)
+        if end != len(value):
+            raise Exception('{} bytes left in coin {} after deserialization'.format(len(value) - end, dbkey.hex()))
+        utxo.store(dbkey[32:0:-1] + pos.to_bytes(4, 'big'), coin.entry())
+
+        count += 1
+        if count % 1000000 == 0:
+            print('loaded {} coins from chainstate'.format(count))
+
+    db.close()
+    return best_block, count
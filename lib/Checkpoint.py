@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import shutil
+
+from .UTXO import ENTRY
+
+# A checkpoint holds the complete state of parse_blockchain.py after a given
+# block has been processed, so a run can be resumed from there. Each one is a
+# directory <directory>/<height>/ containing
+#
+# utxo.dat:  the UTXO set as fixed-size records (36-byte key followed by the
+#            packed entry), written and read in chunks
+# state.pkl: everything else: height, window contents, histograms, output
+#            directory and the sizes of all output files
+#
+# The file <directory>/latest holds the height of the last complete
+# checkpoint. It is replaced atomically once a new checkpoint has been
+# written completely, after which older checkpoints are removed.
+
+RECORD_SIZE = 36 + ENTRY.size
+CHUNK_RECORDS = 100000
+
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f)
+
+def fsync_directory(directory):
+    # make renames within directory durable
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def save(directory, height, utxo, window, log, extra=None):
+    path = '{}/{}'.format(directory, height)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    # UTXO set
+    count = 0
+    with open(tmp + '/utxo.dat', 'wb') as f:
+        chunk = []
+        for key, entry in utxo.items():
+            chunk.append(key)
+            chunk.append(entry)
+            if len(chunk) == 2 * CHUNK_RECORDS:
+                f.write(b''.join(chunk))
+                count += CHUNK_RECORDS
+                chunk = []
+        f.write(b''.join(chunk))
+        count += len(chunk) // 2
+        f.flush()
+        os.fsync(f)
+
+    # everything else; output files are flushed, so their current size
+    # corresponds to this height
+    state = {
+        'height': height,
+        'utxo_count': count,
+        'window': window.metrics,
+        'histograms': log.histograms,
+        'log_directory': log.directory,
+        'log_offsets': log.flush(),
+        'extra': extra,
+    }
+    write_file(tmp + '/state.pkl', pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+
+    # make checkpoint visible; a checkpoint for the same height may be left
+    # over from an earlier run (e.g., one that crashed before updating
+    # latest), it is replaced
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    fsync_directory(directory)
+    write_file(directory + '/latest.tmp', str(height).encode())
+    os.replace(directory + '/latest.tmp', directory + '/latest')
+    fsync_directory(directory)
+
+    # remove older checkpoints, including incomplete ones (<height>.tmp);
+    # anything else in directory (e.g. a latest.tmp left over from a crash) is
+    # left alone
+    for name in os.listdir(directory):
+        path = '{}/{}'.format(directory, name)
+        checkpoint = name[:-len('.tmp')] if name.endswith('.tmp') else name
+        if name != str(height) and checkpoint.isdigit() and os.path.isdir(path):
+            shutil.rmtree(path)
+
+def load(directory, utxo, window, log):
+    # restore state from last checkpoint; returns its height and the extra
+    # data passed to save()
+    with open(directory + '/latest') as f:
+        height = int(f.read())
+    path = '{}/{}'.format(directory, height)
+    with open(path + '/state.pkl', 'rb') as f:
+        state = pickle.load(f)
+    if state['height'] != height:
+        raise Exception('checkpoint in {} is for height {}, not {}'.format(path, state['height'], height))
+
+    utxo.clear()
+    count = 0
+    with open(path + '/utxo.dat', 'rb') as f:
+        while True:
+            chunk = f.read(RECORD_SIZE * CHUNK_RECORDS)
+            if not chunk:
+                break
+            for pos in range(0, len(chunk), RECORD_SIZE):
+                utxo.store(chunk[pos:pos+36], ENTRY.unpack_from(chunk, pos+36))
+            count += len(chunk) // RECORD_SIZE
+    if count != state['utxo_count']:
+        raise Exception('checkpoint in {} contains {} UTXOs, but should contain {}'.format(path, count, state['utxo_count']))
+
+    window.metrics = state['window']
+    log.resume(state['log_directory'], state['log_offsets'], state['histograms'])
+    return height, state['extra']
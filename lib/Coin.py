@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+from .Script import Script
+from .tools import read_core_varint
+from .compression import read_compressed_txout
+from .Output import txout_type_solver
+from .UTXO import utxo_entry
+
+class Coin:
+    # An unspent output as stored by Bitcoin Core in undo data and the
+    # chainstate (see Coin in Bitcoin Core's src/coins.h). entry() converts it
+    # into a UTXO set entry, so it can be used in place of the UTXO set.
+
+    __slots__ = ['amount', 'script_pubkey', 'height', 'coinbase']
+
+    def __init__(self, amount, script_pubkey, height, coinbase):
+        self.amount = amount
+        self.script_pubkey = script_pubkey
+        self.height = height
+        self.coinbase = coinbase
+
+    def entry(self):
+        # same as the UTXO set entry of the output (see utxo_entry())
+        return utxo_entry(self.amount, self.script_pubkey, txout_type_solver(self.script_pubkey))
+
+    @staticmethod
+    def from_buffer(buf, pos, undo=False):
+        # height and coinbase flag: VARINT(height*2 + coinbase)
+        code, pos = read_core_varint(buf, pos)
+        height = code >> 1
+        coinbase = code & 1 == 1
+        # undo data contains an unused version number for all but the genesis
+        # block (see TxInUndoFormatter in Bitcoin Core's src/undo.h)
+        if undo and height > 0:
+            _, pos = read_core_varint(buf, pos)
+        # compressed amount and script
+        amount, script, pos = read_compressed_txout(buf, pos)
+        return Coin(amount, Script(script), height, coinbase), pos
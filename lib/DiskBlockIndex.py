@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import struct
+
+from .tools import read_core_varint
+
+# Block status bits
+# Taken from Bitcoin Core's BlockStatus in src/chain.h
+BLOCK_HAVE_DATA          =   1<<3 # full block available in blk*.dat
+BLOCK_HAVE_UNDO          =   1<<4 # undo data available in rev*.dat
+BLOCK_FAILED_VALID       =   1<<5 # stage after last reached validness failed
+BLOCK_FAILED_CHILD       =   1<<6 # descends from failed block
+BLOCK_FAILED_MASK        =   BLOCK_FAILED_VALID | BLOCK_FAILED_CHILD
+BLOCK_OPT_WITNESS        =   1<<7 # block data in blk*.data was received with a witness-enforcing client
+
+# block header: version, hash of previous block, merkle root, timestamp,
+# difficulty bits, nonce
+HEADER = struct.Struct('<I32s32sIII')
+
+class DiskBlockIndex:
+    # A block index record as stored in the LevelDB value of Bitcoin Core's
+    # block index (blocks/index/), decoded directly from bytes. Hashes are
+    # kept as raw bytes in the byte order used in the block chain.
+
+    __slots__ = ['version', 'height', 'status', 'ntx', 'fileno', 'datapos', 'undopos', 'blockver', 'hash_prev_block', 'merkle_root', 'timestamp', 'bits', 'nonce']
+
+    def __init__(self, version, height, status, ntx, fileno, datapos, undopos, blockver, hash_prev_block, merkle_root, timestamp, bits, nonce):
+        self.version = version
+        self.height = height
+        self.status = status
+        self.ntx = ntx
+        self.fileno = fileno
+        self.datapos = datapos
+        self.undopos = undopos
+        self.blockver = blockver
+        self.hash_prev_block = hash_prev_block
+        self.merkle_root = merkle_root
+        self.timestamp = timestamp
+        self.bits = bits
+        self.nonce = nonce
+
+    @staticmethod
+    def from_buffer(buf):
+        # See CDiskBlockIndex:SerializationOp in Bitcoin Core's src/chain.h
+        # for data layout used in the LevelDB value
+        buf = memoryview(buf)
+
+        # version of Satoshi client, height, status and number of
+        # transactions (all alternative varints)
+        version, pos = read_core_varint(buf, 0)
+        height, pos = read_core_varint(buf, pos)
+        status, pos = read_core_varint(buf, pos)
+        ntx, pos = read_core_varint(buf, pos)
+
+        # file number, block pos, undo pos (all alternative varints); None if
+        # not applicable
+        fileno = datapos = undopos = None
+        if status & (BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO):
+            fileno, pos = read_core_varint(buf, pos)
+        if status & BLOCK_HAVE_DATA:
+            datapos, pos = read_core_varint(buf, pos)
+        if status & BLOCK_HAVE_UNDO:
+            undopos, pos = read_core_varint(buf, pos)
+
+        # block header
+        blockver, hash_prev_block, merkle_root, timestamp, bits, nonce = HEADER.unpack_from(buf, pos)
+        pos += HEADER.size
+
+        # make sure we read all data
+        if pos != len(buf):
+            raise Exception('{} bytes left in block index record after deserialization'.format(len(buf) - pos))
+
+        return DiskBlockIndex(version, height, status, ntx, fileno, datapos, undopos, blockver, hash_prev_block, merkle_root, timestamp, bits, nonce)
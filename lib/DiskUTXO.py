@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import sys
+import plyvel
+from collections import OrderedDict
+
+from .UTXO import UTXO, ENTRY
+
+class DiskUTXO(UTXO):
+    # UTXO set stored in a LevelDB database, with a write-back cache in
+    # memory. New entries are only kept in the cache. Once it exceeds its
+    # budget of cache_bytes, the oldest entries (UTXOs are spent at most once,
+    # so age is a good proxy for recent use) are written to the database in
+    # a single batch, evicting a fraction flush_fraction of the cache at a
+    # time. UTXOs created and spent while still in the cache never touch the
+    # database. UTXOs spent after having been evicted are read from the
+    # database, and their deletion is written with the next batch.
+    #
+    # Creating the object only opens the database in path (creating it if
+    # missing); an existing one is left alone until clear() is called, which
+    # discards it. Entries left in it by an earlier run are not accounted for,
+    # so the set must be cleared (or loaded from a checkpoint, which clears
+    # it) before use.
+
+    def __init__(self, path, cache_bytes=1024**3, flush_fraction=0.1):
+        super().__init__()
+        self.path = path
+        # every cache entry has the same size: a 36-byte key, a packed entry
+        # and the linked-list node of the OrderedDict
+        self.entry_bytes = sys.getsizeof(bytes(36)) + sys.getsizeof(bytes(ENTRY.size)) + 100
+        self.max_entries = max(1, cache_bytes // self.entry_bytes)
+        self.flush_entries = max(1, int(self.max_entries * flush_fraction))
+
+        self.cache = OrderedDict()  # new entries, oldest first
+        self.deleted = []           # keys of spent entries to delete from database
+        self.stored = 0             # number of entries in database
+
+        self.hits = 0       # entries consumed from cache
+        self.misses = 0     # entries consumed from database
+        self.flushes = 0    # number of batches written to database
+        self.flushed = 0    # number of entries written to database
+
+        self.db = plyvel.DB(self.path, create_if_missing=True, compression=None)
+
+    def insert(self, key, entry):
+        self.cache[key] = entry
+        if len(self.cache) > self.max_entries:
+            self.flush(self.flush_entries)
+
+    def remove(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        entry = self.db.get(key)
+        if entry is None:
+            raise KeyError(key)
+        self.misses += 1
+        self.stored -= 1
+        self.deleted.append(key)
+        return entry
+
+    def remove_many(self, keys):
+        # look up all keys missing from the cache with a single database
+        # iterator; keys are sorted, so it only ever seeks forward
+        resolved = {}
+        missing = []
+        for key in keys:
+            entry = self.cache.pop(key, None)
+            if entry is None:
+                missing.append(key)
+            else:
+                resolved[key] = entry
+        self.hits += len(resolved)
+
+        if missing:
+            it = self.db.raw_iterator()
+            for key in missing:
+                it.seek(key)
+                if not it.valid() or it.key() != key:
+                    raise KeyError(key)
+                resolved[key] = it.value()
+            self.misses += len(missing)
+            self.stored -= len(missing)
+            self.deleted.extend(missing)
+        return resolved
+
+    def flush(self, nentries=None):
+        # write the nentries oldest cache entries (all if None) and pending
+        # deletions to the database
+        if nentries is None:
+            nentries = len(self.cache)
+        with self.db.write_batch() as batch:
+            # deletions first: a key may be spent and then added again (see
+            # BIP 30)
+            for key in self.deleted:
+                batch.delete(key)
+            for _ in range(min(nentries, len(self.cache))):
+                key, entry = self.cache.popitem(last=False)
+                batch.put(key, entry)
+                self.flushed += 1
+                self.stored += 1
+        self.deleted.clear()
+        self.flushes += 1
+
+    def items(self):
+        # apply pending deletions first
+        self.flush(0)
+        yield from self.db.iterator()
+        yield from self.cache.items()
+
+    def clear(self):
+        super().clear()
+        self.cache.clear()
+        self.deleted.clear()
+        self.stored = 0
+        self.db.close()
+        plyvel.destroy_db(self.path)
+        self.db = plyvel.DB(self.path, create_if_missing=True, compression=None)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return len(self.cache) + self.stored
+
+    def stats(self):
+        return 'UTXO set: {} entries ({} cached), cache hits: {}, misses: {}, flushes: {} ({} entries written)'.format(len(self), len(self.cache), self.hits, self.misses, self.flushes, self.flushed)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from .UTXO import UTXO, ENTRY
+
+VALUE_DTYPE = 'V{}'.format(ENTRY.size)
+
+class Run:
+    # Sorted NumPy arrays (key, packed entry) with a deletion mask, holding
+    # the UTXOs promoted to the old generation between heights first and last
+
+    __slots__ = ['keys', 'values', 'deleted', 'count', 'first', 'last']
+
+    def __init__(self, keys, values, first, last):
+        self.keys = keys
+        self.values = values
+        self.deleted = np.zeros(len(keys), dtype=bool)
+        self.count = len(keys)  # number of entries not marked as deleted
+        self.first = first
+        self.last = last
+
+    def find(self, key):
+        # position of key, -1 if missing or deleted
+        i = int(np.searchsorted(self.keys, np.void(key)))
+        if i < len(self.keys) and self.keys[i].tobytes() == key and not self.deleted[i]:
+            return i
+        return -1
+
+    def live(self):
+        # keys and values not marked as deleted
+        keep = ~self.deleted
+        return self.keys[keep], self.values[keep]
+
+def merge(a, b):
+    # merge two runs into a new one, dropping entries marked as deleted; a key
+    # is never in both runs without being deleted in one of them (see
+    # GenerationalUTXO.promote())
+    a_keys, a_values = a.live()
+    b_keys, b_values = b.live()
+    pos = np.searchsorted(a_keys, b_keys) + np.arange(len(b_keys))
+    from_a = np.ones(len(a_keys) + len(b_keys), dtype=bool)
+    from_a[pos] = False
+    keys = np.empty(len(from_a), dtype='V36')
+    values = np.empty(len(from_a), dtype=VALUE_DTYPE)
+    keys[pos] = b_keys
+    keys[from_a] = a_keys
+    values[pos] = b_values
+    values[from_a] = a_values
+    return Run(keys, values, min(a.first, b.first), max(a.last, b.last))
+
+class GenerationalUTXO(UTXO):
+    # Most UTXOs are spent within a few blocks of their creation, while some
+    # stay unspent for years. This UTXO set keeps three generations:
+    #
+    # young: dict receiving all new UTXOs
+    # aging: dict holding the young generation of the previous interval
+    # old:   sorted runs (see Run), searched newest first by binary search;
+    #        52 bytes per UTXO
+    #
+    # Every interval blocks (see advance()), the UTXOs left in the aging
+    # generation become a new run of the old generation and the young
+    # generation becomes the aging one, so only UTXOs unspent for at least
+    # interval blocks are frozen. Spent old UTXOs are only marked as deleted.
+    # Whenever a run holds at least half as many UTXOs as the one before it,
+    # the two are merged, dropping the deleted entries. Run sizes therefore
+    # decrease geometrically: there are O(log n) runs, and each UTXO is copied
+    # O(log n) times instead of on every promotion. A run whose deleted
+    # entries exceed compact_fraction of it is compacted in place.
+
+    def __init__(self, interval=1000, compact_fraction=0.25):
+        super().__init__()
+        self.interval = interval
+        self.compact_fraction = compact_fraction
+        self.young = {}
+        self.aging = {}
+        self.runs = []      # runs of the old generation, oldest first
+        self.height = 0     # height of the last block connected
+
+        # per generation: number of UTXOs spent and promoted
+        self.spent = {'young': 0, 'aging': 0, 'old': 0}
+        self.promoted = 0
+        self.merges = 0
+        self.compactions = 0
+
+    def insert(self, key, entry):
+        # A UTXO may be added again while the previous one with the same
+        # outpoint is unspent (duplicate txids, see BIP 30). The previous one
+        # is dropped from the aging generation here; in the old generation,
+        # it is only replaced once the new one is promoted, so it is not
+        # looked up on every insert.
+        self.aging.pop(key, None)
+        self.young[key] = entry
+
+    def remove(self, key):
+        entry = self.young.pop(key, None)
+        if entry is not None:
+            self.spent['young'] += 1
+            return entry
+        entry = self.aging.pop(key, None)
+        if entry is not None:
+            self.spent['aging'] += 1
+            return entry
+
+        for run in reversed(self.runs):
+            i = run.find(key)
+            if i >= 0:
+                run.deleted[i] = True
+                run.count -= 1
+                self.spent['old'] += 1
+                return run.values[i].tobytes()
+        raise KeyError(key)
+
+    def advance(self, height):
+        # called after each block has been connected
+        self.height = height
+        if height > 0 and height % self.interval == 0:
+            self.promote()
+
+    def promote(self):
+        # turn the aging generation into a new run of the old one
+        if self.aging:
+            keys = np.array(list(self.aging.keys()), dtype='V36')
+            values = np.array(list(self.aging.values()), dtype=VALUE_DTYPE)
+            order = np.argsort(keys)
+            keys = keys[order]
+            values = values[order]
+            self.promoted += len(keys)
+
+            # UTXOs with the same outpoint in older runs (see BIP 30 for
+            # duplicate txids) are replaced by the new ones
+            for run in self.runs:
+                pos = np.searchsorted(run.keys, keys)
+                found = pos < len(run.keys)
+                found[found] = run.keys[pos[found]] == keys[found]
+                pos = pos[found]
+                pos = pos[~run.deleted[pos]]
+                run.deleted[pos] = True
+                run.count -= len(pos)
+
+            self.runs.append(Run(keys, values, self.height, self.height))
+            while len(self.runs) > 1 and self.runs[-2].count <= 2 * self.runs[-1].count:
+                last = self.runs.pop()
+                self.runs[-1] = merge(self.runs[-1], last)
+                self.merges += 1
+
+            for i, run in enumerate(self.runs):
+                if len(run.keys) - run.count > self.compact_fraction * len(run.keys):
+                    self.runs[i] = self.compact(run)
+
+        self.aging = self.young
+        self.young = {}
+
+    def compact(self, run):
+        # drop entries marked as deleted from a run
+        keys, values = run.live()
+        self.compactions += 1
+        return Run(keys, values, run.first, run.last)
+
+    def items(self):
+        yield from self.young.items()
+        yield from self.aging.items()
+        for run in self.runs:
+            for i in np.flatnonzero(~run.deleted).tolist():
+                yield run.keys[i].tobytes(), run.values[i].tobytes()
+
+    def clear(self):
+        super().clear()
+        self.young.clear()
+        self.aging.clear()
+        self.runs = []
+
+    def old_count(self):
+        return sum(run.count for run in self.runs)
+
+    def __len__(self):
+        return len(self.young) + len(self.aging) + self.old_count()
+
+    def stats(self):
+        # ages in blocks: young UTXOs were created during the current
+        # interval, aging ones during the previous one, and the UTXOs of a
+        # run were aging when it was promoted
+        old_bytes = sum(run.keys.nbytes + run.values.nbytes + run.deleted.nbytes for run in self.runs)
+        deleted = sum(len(run.keys) - run.count for run in self.runs)
+        runs = ', '.join('{} aged {}-{}'.format(run.count, self.height - run.last + self.interval, self.height - run.first + 2 * self.interval) for run in reversed(self.runs))
+        return 'UTXO set: {} entries; young: {} aged 0-{} (spent: {}), aging: {} aged {}-{} (spent: {}), old: {} in {} runs [{}] (spent: {}, marked deleted: {}, {:.1f}MB); promoted: {}, merges: {}, compactions: {}'.format(
+            len(self), len(self.young), self.interval, self.spent['young'], len(self.aging), self.interval, 2 * self.interval, self.spent['aging'],
+            self.old_count(), len(self.runs), runs, self.spent['old'], deleted, old_bytes / (1024**2), self.promoted, self.merges, self.compactions)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+from .UTXO import UTXO, ENTRY, DUPLICATE_OUTPOINTS
+
+# slot states
+EMPTY   = 0
+USED    = 1
+DELETED = 2 # tombstone: slot is free, but lookups must probe past it
+
+# packed entries (see ENTRY in lib/UTXO.py) as a structured dtype, so a batch
+# can be packed and unpacked at once
+ENTRY_DTYPE = np.dtype([('amount', '<u8'), ('type', 'u1'), ('script_size', '<u4'), ('m', 'u1'), ('n', 'u1')])
+
+# mixes the output position into the fingerprint, so outputs of the same tx
+# end up in different slots
+POS_MULTIPLIER = 0x9E3779B97F4A7C15
+MASK64 = (1 << 64) - 1
+
+def fingerprint(key):
+    # 64-bit fingerprint of an outpoint (txid + four-byte position); the txid
+    # is a hash, so its first eight bytes are uniformly distributed already
+    return int.from_bytes(key[:8], 'little') ^ ((int.from_bytes(key[32:], 'big') * POS_MULTIPLIER) & MASK64)
+
+def split_keys(keys):
+    # fingerprints (see fingerprint()) and the rest of the outpoints (txid[8:]
+    # + position) of a list of keys, as arrays; uint64 multiplication wraps
+    # around, like the masked one in fingerprint()
+    data = np.frombuffer(b''.join(keys), dtype=np.uint8).reshape(-1, 36)
+    prefix = data[:, :8].copy().view('<u8').ravel()
+    pos = data[:, 32:].copy().view('>u4').ravel().astype(np.uint64)
+    rest = data[:, 8:].copy().view('V28').ravel()
+    return prefix ^ (pos * np.uint64(POS_MULTIPLIER)), rest
+
+class HashTableUTXO(UTXO):
+    # UTXO set stored in preallocated NumPy arrays instead of a dict, using
+    # open addressing with linear probing on the outpoint's fingerprint. Each
+    # slot takes 52 bytes in parallel columns: state, fingerprint, the rest of
+    # the outpoint (txid[8:] + position), which is compared on every match to
+    # make sure the right coin is returned, and the packed entry. Two
+    # different outpoints with the same fingerprint are not supported; this
+    # raises an exception instead.
+    #
+    # The table is rehashed once used and deleted slots exceed max_load of its
+    # capacity: into a table twice the size if it is more than half full,
+    # otherwise into one of the same size, which only drops tombstones.
+    #
+    # A block's spent and created UTXOs are looked up and inserted in one
+    # batch (see update()): all keys probe at once, one slot per step, so the
+    # number of steps is that of the longest probe sequence instead of the
+    # total number of probes (see find() and place()).
+
+    def __init__(self, capacity=1<<20, max_load=0.7):
+        super().__init__()
+        self.initial_capacity = capacity
+        self.max_load = max_load
+        self.rehashes = 0   # number of times the table was rehashed
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        # capacity must be a power of two
+        if capacity & (capacity - 1):
+            raise Exception('capacity of UTXO hash table must be a power of two, but is {}'.format(capacity))
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.state = np.zeros(capacity, dtype=np.uint8)
+        self.fingerprint = np.zeros(capacity, dtype=np.uint64)
+        self.rest = np.zeros(capacity, dtype='V28')
+        self.value = np.zeros(capacity, dtype='V{}'.format(ENTRY.size))
+        self.count = 0      # number of used slots
+        self.tombstones = 0 # number of deleted slots
+
+    def insert(self, key, entry):
+        fp = fingerprint(key)
+        rest = key[8:]
+        slot = fp & self.mask
+        free = -1
+        while True:
+            state = self.state[slot]
+            if state == EMPTY:
+                break
+            if state == DELETED:
+                if free < 0:
+                    free = slot
+            elif self.fingerprint[slot] == fp:
+                if self.rest[slot].tobytes() != rest:
+                    raise Exception('fingerprint collision in UTXO hash table: {} and {}'.format(key.hex(), (self.rest[slot].tobytes()).hex()))
+                # same outpoint: overwrite, just like a dict would (there are
+                # two pairs of coinbase txs with identical txids, see BIP 30)
+                self.value[slot] = entry
+                return
+            slot = (slot + 1) & self.mask
+
+        # reuse the first tombstone on the probe sequence, if any
+        if free < 0:
+            free = slot
+        else:
+            self.tombstones -= 1
+        self.state[free] = USED
+        self.fingerprint[free] = fp
+        self.rest[free] = rest
+        self.value[free] = entry
+        self.count += 1
+
+        if self.count + self.tombstones > self.max_load * self.capacity:
+            self.rehash(self.capacity * 2 if self.count > self.capacity // 2 else self.capacity)
+
+    def remove(self, key):
+        fp = fingerprint(key)
+        slot = fp & self.mask
+        while True:
+            state = self.state[slot]
+            if state == EMPTY:
+                raise KeyError(key)
+            if state == USED and self.fingerprint[slot] == fp:
+                if self.rest[slot].tobytes() != key[8:]:
+                    raise Exception('fingerprint collision in UTXO hash table: {} and {}'.format(key.hex(), (self.rest[slot].tobytes()).hex()))
+                self.state[slot] = DELETED
+                self.count -= 1
+                self.tombstones += 1
+                return self.value[slot].tobytes()
+            slot = (slot + 1) & self.mask
+
+    def find(self, fp, rest):
+        # slots holding the outpoints with fingerprints fp and rests rest
+        # (see split_keys()), -1 for outpoints that are not in the table
+        slots = (fp & np.uint64(self.mask)).astype(np.int64)
+        found = np.full(len(fp), -1, dtype=np.int64)
+        active = np.arange(len(fp))
+        while len(active):
+            probed = slots[active]
+            state = self.state[probed]
+            match = (state == USED) & (self.fingerprint[probed] == fp[active])
+            found[active[match]] = probed[match]
+            more = ~match & (state != EMPTY)
+            active = active[more]
+            slots[active] = (probed[more] + 1) & self.mask
+
+        hit = np.flatnonzero(found >= 0)
+        collisions = hit[self.rest[found[hit]] != rest[hit]]
+        if len(collisions):
+            i = collisions[0]
+            raise Exception('fingerprint collision in UTXO hash table: {} and {}'.format(rest[i].tobytes().hex(), self.rest[found[i]].tobytes().hex()))
+        return found
+
+    def place(self, fp, rest, value):
+        # put outpoints that are not in the table yet into the first free
+        # (empty or deleted) slot of their probe sequences; if several probe
+        # the same free slot at once, the first one takes it and the others
+        # move on
+        slots = (fp & np.uint64(self.mask)).astype(np.int64)
+        active = np.arange(len(fp))
+        while len(active):
+            probed = slots[active]
+            free = np.flatnonzero(self.state[probed] != USED)
+            taken, first = np.unique(probed[free], return_index=True)
+            placed = active[free[first]]
+            self.tombstones -= int(np.count_nonzero(self.state[taken] == DELETED))
+            self.state[taken] = USED
+            self.fingerprint[taken] = fp[placed]
+            self.rest[taken] = rest[placed]
+            self.value[taken] = value[placed]
+            self.count += len(placed)
+
+            more = np.ones(len(active), dtype=bool)
+            more[free[first]] = False
+            active = active[more]
+            slots[active] = (probed[more] + 1) & self.mask
+
+    def delete(self, keys):
+        # look up all keys at once (see find()) and mark their slots as
+        # deleted; nothing is removed if one of them is missing. Returns the
+        # slots, whose values are left in place.
+        fp, rest = split_keys(keys)
+        slots = self.find(fp, rest)
+        missing = np.flatnonzero(slots < 0)
+        if len(missing):
+            raise KeyError(keys[missing[0]])
+        self.state[slots] = DELETED
+        self.count -= len(keys)
+        self.tombstones += len(keys)
+        return slots
+
+    def remove_many(self, keys):
+        if not keys:
+            return {}
+        values = self.value[self.delete(keys)].tobytes()
+        return {key: values[i*ENTRY.size:(i+1)*ENTRY.size] for i, key in enumerate(keys)}
+
+    def consume_many(self, keys):
+        # same as UTXO.consume_many(), but the entries are unpacked at once
+        if not keys:
+            return {}
+        entries = dict(zip(keys, self.value[self.delete(keys)].view(ENTRY_DTYPE).tolist()))
+        for entry in entries.values():
+            self.aggregates.remove(entry)
+        return entries
+
+    def insert_many(self, keys, entries):
+        # same as insert() for lists of keys and unpacked entries
+        if not keys:
+            return
+        fp, rest = split_keys(keys)
+        value = np.array(entries, dtype=ENTRY_DTYPE).view(self.value.dtype)
+
+        # outpoints already in the table are overwritten (see insert())
+        slots = self.find(fp, rest)
+        found = slots >= 0
+        self.value[slots[found]] = value[found]
+        new = ~found
+        fp, rest, value = fp[new], rest[new], value[new]
+
+        # make room first, so the table never exceeds max_load; it is grown
+        # following the same rule as in insert()
+        while self.count + self.tombstones + len(fp) > self.max_load * self.capacity:
+            self.rehash(self.capacity * 2 if self.count + len(fp) > min(self.max_load, 0.5) * self.capacity else self.capacity)
+        self.place(fp, rest, value)
+
+    def update(self, spent_keys, created):
+        # same as UTXO.update(), but the created UTXOs are inserted in one
+        # batch; outpoints that may be added a second time (see store()) are
+        # stored one by one
+        resolved = self.consume_many(spent_keys)
+        keys = []
+        entries = []
+        for key, entry in created.items():
+            if key in DUPLICATE_OUTPOINTS:
+                self.store(key, entry)
+                continue
+            self.aggregates.add(entry)
+            keys.append(key)
+            entries.append(entry)
+        self.insert_many(keys, entries)
+        return resolved
+
+    def rehash(self, capacity):
+        # move all used slots into a new table. Linear probing places entries
+        # sorted by home slot at max(home slot, previous entry's slot + 1),
+        # which can be computed for all entries at once; only entries pushed
+        # past the end of the table are inserted one by one (wrapping around).
+        used = np.flatnonzero(self.state == USED)
+        fingerprint = self.fingerprint[used]
+        rest = self.rest[used]
+        value = self.value[used]
+
+        self.allocate(capacity)
+        home = (fingerprint & np.uint64(self.mask)).astype(np.int64)
+        order = np.argsort(home, kind='stable')
+        home = home[order]
+        index = np.arange(len(home), dtype=np.int64)
+        slots = np.maximum.accumulate(home - index) + index
+
+        fits = slots < capacity
+        placed = order[fits]
+        self.state[slots[fits]] = USED
+        self.fingerprint[slots[fits]] = fingerprint[placed]
+        self.rest[slots[fits]] = rest[placed]
+        self.value[slots[fits]] = value[placed]
+        self.count = len(placed)
+        for i in order[~fits].tolist():
+            slot = 0
+            while self.state[slot] != EMPTY:
+                slot += 1
+            self.state[slot] = USED
+            self.fingerprint[slot] = fingerprint[i]
+            self.rest[slot] = rest[i]
+            self.value[slot] = value[i]
+            self.count += 1
+        self.rehashes += 1
+
+    def items(self):
+        # the first eight bytes of the txid are not stored, but can be
+        # recovered from the fingerprint
+        for slot in np.flatnonzero(self.state == USED).tolist():
+            rest = self.rest[slot].tobytes()
+            prefix = int(self.fingerprint[slot]) ^ ((int.from_bytes(rest[24:], 'big') * POS_MULTIPLIER) & MASK64)
+            yield prefix.to_bytes(8, 'little') + rest, self.value[slot].tobytes()
+
+    def compact(self):
+        # drop all tombstones
+        self.rehash(self.capacity)
+
+    def clear(self):
+        super().clear()
+        self.allocate(self.initial_capacity)
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        # memory used by the table's columns
+        return self.state.nbytes + self.fingerprint.nbytes + self.rest.nbytes + self.value.nbytes
+
+    def stats(self):
+        return 'UTXO set: {} entries, capacity: {}, tombstones: {}, rehashes: {}, size: {:.1f}MB'.format(self.count, self.capacity, self.tombstones, self.rehashes, self.nbytes() / (1024**2))
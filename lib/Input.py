@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
 from .Script import Script, decode_script
-from .tools import read_varint
+from .tools import read_varint, read_varint_from, UINT32
+import struct
+
+# previous txid (32 bytes) and output position (four bytes)
+OUTPOINT = struct.Struct('<32sI')
 
 class Input:
 
-    __slots__ = ['txid', 'pos', 'script_sig', 'seq_no', 'size', 'spent_UTXO_type', 'spent_UTXO_script', 'witness']
+    __slots__ = ['txid', 'pos', 'script_sig', 'seq_no', 'size', 'spent_UTXO_type', 'spent_UTXO_size', 'spent_UTXO_multisig', 'witness']
 
     def __init__(self, txid, pos, script_sig, seq_no, size):
         self.txid = txid
@@ -19,7 +23,8 @@ class Input:
     def deserialize(stream):
         pos_start = stream.tell()
         # process raw data
-        txid = stream.read(32)[::-1]
+        # txid is used as key in the UTXO set, so make sure it is not a view
+        txid = bytes(stream.read(32)[::-1])
         pos =  int.from_bytes(stream.read(4), 'little')
         len_script_sig = read_varint(stream)
         script_sig = Script(stream.read(len_script_sig))
@@ -28,3 +33,22 @@ class Input:
         size = stream.tell() - pos_start
         # create and return an Input object
         return Input(txid, pos, script_sig, seq_no, size)
+
+    @staticmethod
+    def from_buffer(buf, pos):
+        # same as deserialize(), but reads from an in-memory buffer starting at
+        # offset pos; returns Input object and offset after the input
+        pos_start = pos
+        txid, prev_pos = OUTPOINT.unpack_from(buf, pos)
+        pos += 36
+        len_script_sig = buf[pos]
+        if len_script_sig < 0xFD:
+            pos += 1
+        else:
+            len_script_sig, pos = read_varint_from(buf, pos)
+        script_sig = Script(buf[pos:pos+len_script_sig])
+        pos += len_script_sig
+        seq_no = UINT32.unpack_from(buf, pos)[0]
+        pos += 4
+        # create and return an Input object
+        return Input(txid[::-1], prev_pos, script_sig, seq_no, pos - pos_start), pos
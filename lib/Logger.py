@@ -1,5 +1,6 @@
 from datetime import datetime
 import pandas as pd
+import shutil
 import os
 
 def mem_usage():
@@ -21,10 +22,12 @@ def mem_usage():
 
 
 class Logger:
-    def __init__(self):
+    def __init__(self, directory=None):
         self.histograms = {}
         self.loggers = {}
         self.timestamp = datetime.now().strftime('%Y-%m-%d-%H.%M')
+        # output goes to log/<timestamp>/ unless another directory is given
+        self.directory = directory if directory is not None else 'log/{}'.format(self.timestamp)
 
     def hist(self, base, entries):
         for key, value in entries.items():
@@ -63,7 +66,7 @@ class Logger:
             raise Exception('Warning: target {} already exists: {}'.format(target, self.loggers))
 
         # create directory if it doesn't exist
-        directory = 'log/{}'.format(self.timestamp)
+        directory = self.directory
         if not os.path.exists(directory):
                 os.makedirs(directory)
 
@@ -78,10 +81,67 @@ class Logger:
         f.write(f'{header_line}\n')
         self.loggers[target] = f
 
+    def flush(self):
+        # write all buffered output to disk and return the size of each
+        # output file (see lib/Checkpoint.py)
+        offsets = {}
+        for target, f in self.loggers.items():
+            f.flush()
+            os.fsync(f)
+            offsets[target] = f.tell()
+        return offsets
+
+    def resume(self, directory, offsets, histograms):
+        # continue writing to the output files in directory as of a
+        # checkpoint: truncate them to the sizes in offsets and drop files
+        # created after the checkpoint
+        self.directory = directory
+        self.histograms = histograms
+        for filename in os.listdir(directory):
+            target = filename[:-len('.dat')]
+            if filename.endswith('.dat') and not filename.startswith('histogram_') and target not in offsets:
+                os.remove('{}/{}'.format(directory, filename))
+        for target, offset in offsets.items():
+            f = open('{}/{}.dat'.format(directory, target), 'r+')
+            f.truncate(offset)
+            f.seek(offset)
+            self.loggers[target] = f
+
+    def merge(self, directory, histograms):
+        # append the output files another Logger wrote to directory (e.g. for
+        # the following range of blocks, see lib/Ranges.py) to this Logger's
+        # output files and add its histograms; directory is removed
+        # afterwards. Files and histogram values not seen before are added in
+        # the order in which a single Logger would have created them.
+        filenames = sorted(os.listdir(directory)) if os.path.exists(directory) else []
+        for filename in filenames:
+            if not filename.endswith('.dat'):
+                continue
+            target = filename[:-len('.dat')]
+            with open('{}/{}'.format(directory, filename)) as f:
+                header = f.readline().rstrip('\n').split(',')
+                if target not in self.loggers:
+                    self.open(target, header=header)
+                shutil.copyfileobj(f, self.loggers[target])
+            os.remove('{}/{}'.format(directory, filename))
+        if os.path.exists(directory):
+            os.rmdir(directory)
+        for metric, values in histograms.items():
+            if metric not in self.histograms:
+                self.histograms[metric] = {}
+            for value, count in values.items():
+                self.histograms[metric][value] = self.histograms[metric].get(value, 0) + count
+
+    def close(self):
+        # close all output files without compressing them
+        for f in self.loggers.values():
+            f.close()
+        self.loggers = {}
+
     # create a snapshot of histograms
     def write_histograms(self):
         for target in self.histograms:
-            filename = f'log/{self.timestamp}/histogram_{target}.dat'
+            filename = f'{self.directory}/histogram_{target}.dat'
             f = open(filename, 'w+')
             f.write(f'# {target}\n')
             f.write('# value / occurence\n')
@@ -100,16 +160,16 @@ class Logger:
             f.close()
 
             # read data
-            filename = f'log/{self.timestamp}/{target}.dat'
+            filename = f'{self.directory}/{target}.dat'
             print(f'reading data in {filename} into pandas df...')
             df = pd.read_csv(filename, header=0, index_col=0)
 
             # write bz2-compressed CSV
-            filename = f'log/{self.timestamp}/{target}.csv.bz2'
+            filename = f'{self.directory}/{target}.csv.bz2'
             print(f'writing data to {filename}...')
             df.to_csv(filename, index=True, header=True, compression='bz2')
 
             # remove uncompressed file
-            filename = f'log/{self.timestamp}/{target}.dat'
+            filename = f'{self.directory}/{target}.dat'
             os.remove(filename)
 
@@ -2,7 +2,33 @@
 
 from .Script import Script, decode_script
 from .Constants import TXOUT_TYPE
-from .tools import read_varint
+from .tools import read_varint, read_varint_from, UINT64
+
+def P2SH_type_solver(script_sig=None, witness=None):
+    # P2SH: check for P2SH-P2WSH/P2SH-P2WPKH
+    if script_sig:
+        redeem_script = script_sig.get_redeem_script()
+        if redeem_script.size() == 22 and redeem_script.is_P2WPKH():
+            return TXOUT_TYPE.P2SH_P2WPKH
+        if redeem_script.size() == 34 and redeem_script.is_P2WSH():
+            if witness:
+                witness_script = witness.get_witness_script()
+                if witness_script.is_MULTISIG():
+                    return TXOUT_TYPE.P2SH_P2WSH_MULTISIG
+            # else wrapped P2WSH other than multisig
+            return TXOUT_TYPE.P2SH_P2WSH
+        if redeem_script.is_MULTISIG():
+            return TXOUT_TYPE.P2SH_MULTISIG
+    # no corresponding input provided or no nested segwit found, return regular P2SH
+    return TXOUT_TYPE.P2SH
+
+def P2WSH_type_solver(witness=None):
+    if witness:
+        witness_script = witness.get_witness_script()
+        if witness_script.is_MULTISIG():
+            return TXOUT_TYPE.P2WSH_MULTISIG
+    # no corresponding witness provided or no multisig in witness script
+    return TXOUT_TYPE.P2WSH
 
 def txout_type_solver(script_pubkey, script_sig=None, witness=None):
     # Start with most common types to exit early
@@ -10,23 +36,8 @@ def txout_type_solver(script_pubkey, script_sig=None, witness=None):
     if script_pubkey.is_P2PKH():
         return TXOUT_TYPE.P2PKH
 
-    # P2SH: check for P2SH-P2WSH/P2SH-P2WPKH
     if script_pubkey.is_P2SH():
-        if script_sig:
-            redeem_script = script_sig.get_redeem_script()
-            if redeem_script.size() == 22 and redeem_script.is_P2WPKH():
-                return TXOUT_TYPE.P2SH_P2WPKH
-            if redeem_script.size() == 34 and redeem_script.is_P2WSH():
-                if witness:
-                    witness_script = witness.get_witness_script()
-                    if witness_script.is_MULTISIG():
-                        return TXOUT_TYPE.P2SH_P2WSH_MULTISIG
-                # else wrapped P2WSH other than multisig
-                return TXOUT_TYPE.P2SH_P2WSH
-            if redeem_script.is_MULTISIG():
-                return TXOUT_TYPE.P2SH_MULTISIG
-        # no corresponding input provided or no nested segwit found, return regular P2SH
-        return TXOUT_TYPE.P2SH
+        return P2SH_type_solver(script_sig, witness)
 
     if script_pubkey.is_OP_RETURN():
         return TXOUT_TYPE.OP_RETURN
@@ -35,12 +46,7 @@ def txout_type_solver(script_pubkey, script_sig=None, witness=None):
         return TXOUT_TYPE.P2WPKH
 
     if script_pubkey.is_P2WSH():
-        if witness:
-            witness_script = witness.get_witness_script()
-            if witness_script.is_MULTISIG():
-                return TXOUT_TYPE.P2WSH_MULTISIG
-        # no corresponding witness provided or no multisig in witness script
-        return TXOUT_TYPE.P2WSH
+        return P2WSH_type_solver(witness)
 
     if script_pubkey.is_P2W_UNKNOWN():
         return TXOUT_TYPE.P2W_UNKNOWN
@@ -58,6 +64,17 @@ def txout_type_solver(script_pubkey, script_sig=None, witness=None):
     # Fallback
     return TXOUT_TYPE.NONSTANDARD
 
+def spent_type_solver(created_UTXO_type, script_sig=None, witness=None):
+    # same as txout_type_solver(), but starting from the type determined when
+    # the UTXO was created instead of its script_pubkey: only P2SH and P2WSH
+    # are refined using the spending input's script_sig and witness, all other
+    # types do not depend on the input
+    if created_UTXO_type == TXOUT_TYPE.P2SH:
+        return P2SH_type_solver(script_sig, witness)
+    if created_UTXO_type == TXOUT_TYPE.P2WSH:
+        return P2WSH_type_solver(witness)
+    return created_UTXO_type
+
 class Output:
 
     __slots__ = ['amount', 'script_pubkey', 'created_UTXO_type', 'size']
@@ -74,9 +91,29 @@ class Output:
         # process raw data
         amount = int.from_bytes(stream.read(8), 'little')
         len_scipt_pubkey = read_varint(stream)
-        script_pubkey = Script(stream.read(len_scipt_pubkey))
+        # script_pubkey is kept in the UTXO set, so make sure it is not a view
+        script_pubkey = Script(bytes(stream.read(len_scipt_pubkey)))
         created_UTXO_type = txout_type_solver(script_pubkey)
         # determine input size
         size = stream.tell() - pos_start
         # create and return an Output object
         return Output(amount, script_pubkey, created_UTXO_type, size)
+
+    @staticmethod
+    def from_buffer(buf, pos):
+        # same as deserialize(), but reads from an in-memory buffer starting at
+        # offset pos; returns Output object and offset after the output
+        pos_start = pos
+        amount = UINT64.unpack_from(buf, pos)[0]
+        pos += 8
+        len_scipt_pubkey = buf[pos]
+        if len_scipt_pubkey < 0xFD:
+            pos += 1
+        else:
+            len_scipt_pubkey, pos = read_varint_from(buf, pos)
+        # script_pubkey is kept in the UTXO set, so make sure it is not a view
+        script_pubkey = Script(bytes(buf[pos:pos+len_scipt_pubkey]))
+        pos += len_scipt_pubkey
+        created_UTXO_type = txout_type_solver(script_pubkey)
+        # create and return an Output object
+        return Output(amount, script_pubkey, created_UTXO_type, pos - pos_start), pos
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .Block import Block
+from .Transaction import Transaction
+from .BlockReader import BufferStream
+from .Undo import read_block_undo
+
+def decode(height, raw, raw_undo, parser='buffer', undo=False, offsets=None, decoder=None):
+    # deserialize a block, which includes calculating its txids and the
+    # created UTXO types of its outputs, and, if undo is set, turn the block's
+    # undo data into one list of UTXO set entries per non-coinbase tx (see
+    # Block.connect()); returns height, Block object and the entries (None if
+    # undo is not set). If the positions of the block's txs are known
+    # (offsets), they are deserialized in parallel by decoder.
+    if parser == 'buffer':
+        b = Block.from_buffer(raw, offsets=offsets, decoder=decoder)
+    else:
+        b = Block.deserialize(BufferStream(raw))
+
+    # there must not be any data left in the block's Stream after it has been
+    # deserialized
+    if b.size != len(raw):
+        raise Exception('{} bytes left in serialized stream after deserialization !'.format(len(raw) - b.size))
+
+    # there's no undo data for the genesis block
+    spent = None
+    if undo:
+        spent = [[coin.entry() for coin in coins] for coins in read_block_undo(raw_undo)] if raw_undo is not None else []
+    return height, b, spent
+
+def decode_batch(batch, parser, undo):
+    # executed in a worker process: decode a batch of blocks and detach them
+    # from the serialized data, so they can be sent back to the parent
+    decoded = []
+    for height, raw, raw_undo in batch:
+        height, b, spent = decode(height, raw, raw_undo, parser, undo)
+        b.detach()
+        decoded.append((height, b, spent))
+    return decoded
+
+def gil_enabled():
+    # sys._is_gil_enabled() was added in Python 3.13; the GIL can only be
+    # disabled in free-threaded builds, and there's always one before
+    is_enabled = getattr(sys, '_is_gil_enabled', None)
+    return True if is_enabled is None else is_enabled()
+
+def decode_threads(threads=None):
+    # number of threads to decode blocks in: with the GIL, only one thread
+    # can deserialize at a time, so threads are not used at all (0); without
+    # it, threads is used, or one per CPU but one, which is left for the
+    # thread using the UTXO set and collecting statistics, if threads is None
+    if gil_enabled():
+        return 0
+    if threads is None:
+        return max((os.cpu_count() or 1) - 1, 1)
+    return threads
+
+def decode_blocks(blocks, parser='buffer', undo=False, tx_offsets=None, decoder=None):
+    # decode blocks (height, serialized block and undo data, e.g. as yielded
+    # by read_blocks()) one after the other in this process; the txs of
+    # blocks whose tx positions are in tx_offsets (see lib/TxOffsets.py) are
+    # deserialized in parallel by decoder
+    for height, raw, raw_undo in blocks:
+        offsets = tx_offsets.get(height) if tx_offsets is not None and decoder is not None else None
+        yield decode(height, raw, raw_undo, parser, undo, offsets, decoder)
+
+def decode_chunk(buf, offsets, stop):
+    # deserialize consecutive txs starting at offsets in buf, the last one
+    # ending at stop, and calculate their txids
+    txs = []
+    pos = offsets[0]
+    for offset in offsets:
+        if pos != offset:
+            raise Exception('tx at position {} does not start at recorded offset {}'.format(pos, offset))
+        tx, pos = Transaction.from_buffer(buf, pos)
+        txs.append(tx)
+    if pos != stop:
+        raise Exception('last tx ends at position {} instead of {}'.format(pos, stop))
+    Block.compute_txids(txs)
+    return txs
+
+class TxDecoder:
+    # Deserialize the txs of a single block in parallel: the block is split
+    # into chunks of about equal size at the recorded tx positions, and the
+    # chunks are deserialized by worker threads, which share the block with
+    # this thread. The txs are returned in block order. This only pays off
+    # without the GIL (see decode_threads()); worker processes would have to
+    # pickle the txs, and unpickling them takes about as long as
+    # deserializing the block in the first place.
+
+    def __init__(self, workers=None, chunks=None):
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.chunks = chunks if chunks is not None else 2 * self.workers
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='txdecode')
+        self.blocks = 0             # number of blocks decoded in chunks
+
+    def decode(self, buf, offsets, stop):
+        # split at the txs closest to equally spaced positions
+        targets = [offsets[0] + (stop - offsets[0]) * i // self.chunks for i in range(self.chunks)]
+        bounds = sorted(set(bound for bound in np.searchsorted(offsets, targets).tolist() if bound < len(offsets))) + [len(offsets)]
+        chunk_offsets = []
+        stops = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            chunk_offsets.append(offsets[first:last])
+            stops.append(offsets[last] if last < len(offsets) else stop)
+        self.blocks += 1
+        chunks = self.pool.map(decode_chunk, [buf] * len(stops), chunk_offsets, stops)
+        return [tx for chunk in chunks for tx in chunk]
+
+    def close(self):
+        self.pool.shutdown()
+
+class DecodePool:
+    # Decode blocks in a pool of worker processes. Blocks are sent to the
+    # workers in batches of about batch_bytes bytes (early blocks are tiny,
+    # sending them one by one would cost more than decoding them); at most
+    # depth batches are in flight at any time, so reading never gets far
+    # ahead of the consumer. Results are yielded in the order the blocks were
+    # read, so everything depending on the UTXO set can be done in a single,
+    # ordered stage in the parent.
+    #
+    # The pool forks the current process, so create it before the UTXO set
+    # grows and before any threads (e.g. a Prefetcher's) are started. Fork is
+    # requested explicitly: workers started any other way would import
+    # lib/globals.py again and set up a second UTXO set.
+
+    pickled = True      # blocks are pickled to be sent to the workers
+
+    def __init__(self, processes=None, depth=None, batch_bytes=4*1024*1024, parser='buffer', undo=False):
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.pool = self.create_pool()
+        self.depth = depth if depth is not None else 2 * self.processes
+        self.batch_bytes = batch_bytes
+        self.parser = parser
+        self.undo = undo
+        self.batches = 0            # number of batches sent to workers
+        self.max_pending = 0        # maximum number of batches in flight
+
+    def create_pool(self):
+        # the workers decoding the batches
+        return multiprocessing.get_context('fork').Pool(self.processes)
+
+    def start(self, batch):
+        # start decoding a batch; returns something collect() can wait for
+        return self.pool.apply_async(decode_batch, (batch, self.parser, self.undo))
+
+    def submit(self, pending, batch):
+        pending.append(self.start(batch))
+        self.batches += 1
+        self.max_pending = max(self.max_pending, len(pending))
+
+    def collect(self, result):
+        # wait for a batch and return the decoded blocks
+        return result.get()
+
+    def map(self, blocks):
+        # decode blocks (see decode_blocks()) in the worker processes
+        pending = deque()
+        batch = []
+        size = 0
+        for height, raw, raw_undo in blocks:
+            # views into memory-mapped files cannot be pickled
+            if self.pickled and isinstance(raw, memoryview):
+                raw = bytes(raw)
+            if self.pickled and isinstance(raw_undo, memoryview):
+                raw_undo = bytes(raw_undo)
+            batch.append((height, raw, raw_undo))
+            size += len(raw)
+            if size < self.batch_bytes:
+                continue
+            self.submit(pending, batch)
+            batch = []
+            size = 0
+            # wait for the oldest batch if too many are in flight
+            while len(pending) >= self.depth:
+                yield from self.collect(pending.popleft())
+        if batch:
+            self.submit(pending, batch)
+        while pending:
+            yield from self.collect(pending.popleft())
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class ThreadDecodePool(DecodePool):
+    # Same as DecodePool, but blocks are decoded in threads of this process,
+    # so nothing needs to be pickled or copied. This only pays off without the
+    # GIL (see decode_threads()). Deserializing a block does not touch any
+    # shared state; the UTXO set and the Logger (see lib/globals.py) are
+    # confined to the thread iterating over map(), which must be the only
+    # thread using them.
+
+    pickled = False
+
+    def create_pool(self):
+        # processes is the number of threads
+        return ThreadPoolExecutor(self.processes, thread_name_prefix='decode')
+
+    def decode(self, batch):
+        # executed in a worker thread
+        return list(decode_blocks(batch, self.parser, self.undo))
+
+    def start(self, batch):
+        return self.pool.submit(self.decode, batch)
+
+    def collect(self, future):
+        return future.result()
+
+    def close(self):
+        self.pool.shutdown()
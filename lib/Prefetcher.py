@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import mmap
+import threading
+from collections import deque
+
+def touch(view):
+    # read one byte of every page of a view into a memory-mapped file, so the
+    # pages are read from disk in this thread; nothing is copied
+    if len(view) > 0:
+        view[::mmap.PAGESIZE].tobytes()
+        view[-1]
+
+class Prefetcher:
+    # Read blocks in a background thread while the consumer is busy
+    # deserializing and processing earlier blocks, so that I/O and CPU
+    # overlap. Blocks are taken from source (an iterable yielding height,
+    # serialized block and undo data, e.g. read_blocks()) and buffered in a
+    # queue that is bounded both in number of blocks (depth) and in bytes
+    # (max_bytes). Iterating over a Prefetcher yields the same items as
+    # iterating over source.
+
+    def __init__(self, source, depth=64, max_bytes=256*1024*1024):
+        self.source = source
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.bytes = 0                  # size of blocks in queue [B]
+        self.done = False               # True once source is exhausted
+        self.error = None               # exception raised in reader thread
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        try:
+            for height, raw, raw_undo in self.source:
+                # data in a memory-mapped file is only read from disk once it
+                # is accessed; touch it here so this happens in this thread,
+                # and pass the views on unchanged
+                if isinstance(raw, memoryview):
+                    touch(raw)
+                if isinstance(raw_undo, memoryview):
+                    touch(raw_undo)
+                size = len(raw) + (len(raw_undo) if raw_undo is not None else 0)
+                with self.cond:
+                    # wait for room in queue; always accept a block if the
+                    # queue is empty, even if it exceeds the byte budget
+                    while self.queue and (len(self.queue) >= self.depth or self.bytes + size > self.max_bytes):
+                        self.cond.wait()
+                    self.queue.append((height, raw, raw_undo, size))
+                    self.bytes += size
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def __iter__(self):
+        self.thread.start()
+        while True:
+            with self.cond:
+                while not self.queue and not self.done:
+                    self.cond.wait()
+                if not self.queue:
+                    # reader thread finished: re-raise its error, if any
+                    if self.error is not None:
+                        raise self.error
+                    return
+                height, raw, raw_undo, size = self.queue.popleft()
+                self.bytes -= size
+                self.cond.notify_all()
+            yield height, raw, raw_undo
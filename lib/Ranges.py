@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+
+from . import BlockIndex
+from .BlockReader import MmapBlockReader, read_blocks
+from .Pipeline import decode_blocks
+from .Window import Window
+from .globals import log
+from .globals import window_sizes
+from .statistics import process
+
+# With undo data, the UTXOs spent by a block do not depend on any other block,
+# and all windows start at multiples of the largest window size. The chain
+# can therefore be split into ranges of heights, aligned to the largest
+# window size, that are processed independently of each other, each in a
+# worker process with its own Window and with output going to its own
+# directory. The output of all ranges is then merged in order (see
+# Logger.merge()), which gives the same result as processing all blocks one
+# after the other.
+
+def split(start, stop, size):
+    # split heights start to stop-1 into ranges of size blocks, rounded up to
+    # a multiple of the largest window size; returns a list of first and
+    # stop height of each range
+    step = max(window_sizes)
+    if start % step != 0:
+        raise Exception('ranges must start at a multiple of {}, not at {}'.format(step, start))
+    size = -(-size // step) * step
+    return [(first, min(first + size, stop)) for first in range(start, stop, size)]
+
+def process_range(task):
+    # executed in a worker process: collect statistics for the blocks in one
+    # range; returns the range, the number of bytes processed, the output
+    # directory and the histograms
+    datadir, indexdb, parser, first, stop, directory = task
+
+    # output of this range goes to its own directory; a worker process may
+    # handle several ranges one after the other
+    log.directory = directory
+    log.loggers = {}
+    log.histograms = {}
+
+    blockindex = BlockIndex.load(indexdb)
+    reader = MmapBlockReader(datadir)
+    window = Window(window_sizes)
+    size = 0
+    for height, b, spent in decode_blocks(read_blocks(reader, blockindex[:stop], undo=True, start=first), parser=parser, undo=True):
+        b.connect(spent=spent)
+        process(b, height, window, undo=True)
+        size += b.size
+    reader.close()
+    log.close()
+    return first, stop, size, directory, log.histograms
+
+def run(datadir, indexdb, ranges, processes=None, parser='buffer'):
+    # process ranges (see split()) in processes worker processes (None for
+    # one per CPU) and merge their output into log as soon as all ranges
+    # before it are done; yields each range's first and stop height and the
+    # number of bytes processed, in range order. Workers are forked, so they
+    # share this process's Logger settings and don't import lib/globals.py
+    # (and set up a UTXO set) again.
+    tasks = [(datadir, indexdb, parser, first, stop, '{}/range-{:08}'.format(log.directory, first)) for first, stop in ranges]
+    with multiprocessing.get_context('fork').Pool(processes) as pool:
+        for first, stop, size, directory, histograms in pool.imap(process_range, tasks):
+            log.merge(directory, histograms)
+            yield first, stop, size
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+
+from .UTXO import UTXO, ENTRY, DUPLICATE_OUTPOINTS
+
+KEY_SIZE = 36
+RECORD_SIZE = KEY_SIZE + ENTRY.size
+
+# number of records buffered per shard by insert() before they are sent, and
+# number of records per reply when iterating over a shard (see items())
+INSERT_BATCH = 10000
+ITEMS_BATCH = 100000
+
+def serve(conn):
+    # Worker process owning one shard of the UTXO set: a dict mapping keys to
+    # packed entries. Requests are tuples; block requests carry the spent keys
+    # and the created (key, entry) records each joined into a single bytes
+    # object, and are answered with the spent entries, joined the same way.
+    shard = {}
+    while True:
+        request = conn.recv()
+        op = request[0]
+        if op == 'block':
+            _, spent, created = request
+            keys = [spent[pos:pos+KEY_SIZE] for pos in range(0, len(spent), KEY_SIZE)]
+            # make sure all keys are there before removing any, so the shard
+            # is left unchanged if one is missing
+            missing = [key for key in keys if key not in shard]
+            if missing:
+                conn.send(KeyError(missing[0]))
+                continue
+            entries = [shard.pop(key) for key in keys]
+            for pos in range(0, len(created), RECORD_SIZE):
+                shard[created[pos:pos+KEY_SIZE]] = created[pos+KEY_SIZE:pos+RECORD_SIZE]
+            conn.send(b''.join(entries))
+        elif op == 'insert':
+            records = request[1]
+            for pos in range(0, len(records), RECORD_SIZE):
+                shard[records[pos:pos+KEY_SIZE]] = records[pos+KEY_SIZE:pos+RECORD_SIZE]
+        elif op == 'remove':
+            conn.send(shard.pop(request[1], None))
+        elif op == 'items':
+            # records in chunks of ITEMS_BATCH, followed by an empty one
+            records = []
+            for key, entry in shard.items():
+                records.append(key + entry)
+                if len(records) == ITEMS_BATCH:
+                    conn.send_bytes(b''.join(records))
+                    records = []
+            if records:
+                conn.send_bytes(b''.join(records))
+            conn.send_bytes(b'')
+        elif op == 'len':
+            conn.send(len(shard))
+        elif op == 'clear':
+            shard.clear()
+        elif op == 'stop':
+            break
+        else:
+            raise Exception('unknown request {}'.format(op))
+
+class ShardedUTXO(UTXO):
+    # UTXO set split into nshards shards by the first byte of the txid, each
+    # one owned by a worker process (see serve()). For every block, each shard
+    # receives a single request with all of its spent and created UTXOs (see
+    # update()); the requests are sent to all shards before waiting for any
+    # reply, so the shards work in parallel. Single inserts (e.g. when loading
+    # a checkpoint) are buffered and sent in batches as well. Aggregates and
+    # the number of entries are maintained here.
+    #
+    # The workers are forked: the set is created while lib/globals.py is
+    # imported, and workers started any other way would import it again and
+    # start shards of their own.
+
+    def __init__(self, nshards=4):
+        super().__init__()
+        self.conns = []
+        self.workers = []
+        context = multiprocessing.get_context('fork')
+        for i in range(nshards):
+            parent, child = context.Pipe()
+            worker = context.Process(target=serve, args=(child,), daemon=True)
+            worker.start()
+            self.conns.append(parent)
+            self.workers.append(worker)
+        self.pending = [[] for _ in range(nshards)]    # records buffered by insert()
+        self.size = 0       # number of entries
+        self.requests = 0   # number of batched requests sent
+
+    def shard(self, key):
+        return key[0] % len(self.conns)
+
+    def flush(self):
+        # send the records buffered by insert(); called before any other
+        # request, so requests are handled in the order they were made
+        for i, records in enumerate(self.pending):
+            if records:
+                self.conns[i].send(('insert', b''.join(records)))
+                self.requests += 1
+                self.pending[i] = []
+
+    def insert(self, key, entry):
+        # keys are never inserted twice (see store()), so the entry is new
+        records = self.pending[self.shard(key)]
+        records.append(key + entry)
+        self.size += 1
+        if len(records) >= INSERT_BATCH:
+            self.flush()
+
+    def remove(self, key):
+        self.flush()
+        conn = self.conns[self.shard(key)]
+        conn.send(('remove', key))
+        entry = conn.recv()
+        if entry is None:
+            raise KeyError(key)
+        self.size -= 1
+        return entry
+
+    def update(self, spent_keys, created):
+        self.flush()
+        nshards = len(self.conns)
+        spent = [[] for _ in range(nshards)]
+        records = [[] for _ in range(nshards)]
+        for key in spent_keys:
+            spent[key[0] % nshards].append(key)
+        for key, entry in created.items():
+            # overwriting a UTXO needs its previous entry (see store())
+            if key in DUPLICATE_OUTPOINTS:
+                self.store(key, entry)
+                self.flush()
+                continue
+            self.aggregates.add(entry)
+            records[key[0] % nshards].append(key + ENTRY.pack(*entry))
+
+        for conn, keys, shard_records in zip(self.conns, spent, records):
+            conn.send(('block', b''.join(keys), b''.join(shard_records)))
+        self.requests += nshards
+
+        # read all replies, even if one shard failed, so that no reply is
+        # left in a pipe to be mistaken for the answer to a later request
+        replies = [conn.recv() for conn in self.conns]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+
+        resolved = {}
+        for reply, keys, shard_records in zip(replies, spent, records):
+            for i, key in enumerate(keys):
+                entry = ENTRY.unpack_from(reply, i * ENTRY.size)
+                self.aggregates.remove(entry)
+                resolved[key] = entry
+            self.size += len(shard_records) - len(keys)
+        return resolved
+
+    def items(self):
+        self.flush()
+        for conn in self.conns:
+            conn.send(('items',))
+            records = conn.recv_bytes()
+            try:
+                while records:
+                    for pos in range(0, len(records), RECORD_SIZE):
+                        yield records[pos:pos+KEY_SIZE], records[pos+KEY_SIZE:pos+RECORD_SIZE]
+                    records = conn.recv_bytes()
+            finally:
+                # read the rest of the shard if the caller stopped early
+                while records:
+                    records = conn.recv_bytes()
+
+    def clear(self):
+        super().clear()
+        self.pending = [[] for _ in self.conns]
+        self.size = 0
+        for conn in self.conns:
+            conn.send(('clear',))
+
+    def close(self):
+        self.flush()
+        for conn in self.conns:
+            conn.send(('stop',))
+        for worker in self.workers:
+            worker.join()
+
+    def shard_sizes(self):
+        self.flush()
+        for conn in self.conns:
+            conn.send(('len',))
+        return [conn.recv() for conn in self.conns]
+
+    def __len__(self):
+        return self.size
+
+    def stats(self):
+        sizes = self.shard_sizes()
+        return 'UTXO set: {} entries in {} shards ({}), batched requests: {}'.format(sum(sizes), len(sizes), ', '.join(str(size) for size in sizes), self.requests)
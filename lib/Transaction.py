@@ -1,18 +1,17 @@
 #!/usr/bin/env python3
 
 from .Input import Input
-from .Output import Output, txout_type_solver
+from .Output import Output, spent_type_solver
 from .Witness import Witness
-from .globals import utxo
-from .tools import hash256, read_varint
+from .tools import read_varint, read_varint_from, UINT32
 from .Constants import TXOUT_TYPE
 import os
 
 class Transaction:
 
-    __slots__ = ['version', 'is_segwit', 'inputs', 'outputs', 'locktime', 'fee', 'size', 'stripped_size', 'txid', 'weight']
+    __slots__ = ['version', 'is_segwit', 'inputs', 'outputs', 'locktime', 'fee', 'size', 'stripped_size', 'txid', 'txid_data', 'weight']
 
-    def __init__(self, version, segwit, inputs, outputs, locktime, size, stripped_size, txid):
+    def __init__(self, version, segwit, inputs, outputs, locktime, size, stripped_size, txid_data):
         self.version = version
         self.is_segwit = segwit
         self.inputs = inputs
@@ -20,11 +19,25 @@ class Transaction:
         self.locktime = locktime
         self.size = size
         self.stripped_size = stripped_size
-        self.txid = txid
+        # segments of serialized tx making up the txid's preimage; the txid
+        # itself is calculated for all of a block's txs at once (see
+        # Block.compute_txids())
+        self.txid = None
+        self.txid_data = txid_data
         self.weight = stripped_size * 4 + (size - stripped_size)
 
-    def fee_and_type(self):
-        # calculate transaction fee and annotate spent UTXO types in inputs
+    def detach(self):
+        # replace views into the serialized block (script_sigs and witness
+        # items) by copies
+        for inp in self.inputs:
+            inp.script_sig.data = bytes(inp.script_sig.data)
+            if inp.witness is not None:
+                inp.witness.items = [bytes(item) for item in inp.witness.items]
+
+    def fee_and_type(self, spent):
+        # calculate transaction fee and annotate spent UTXO types in inputs;
+        # spent holds the unpacked UTXO set entries of the UTXOs spent by the
+        # inputs (see Block.connect()), none for the coinbase tx
 
         # check for coinbase
         if self.inputs[0].txid == b'\x00' * 32 and self.inputs[0].pos == int('ff'*4, 16):
@@ -33,21 +46,21 @@ class Transaction:
             return
 
         # non-coinbase tx
+        if len(spent) != len(self.inputs):
+            raise Exception('{} spent UTXOs provided for {} inputs in {}'.format(len(spent), len(self.inputs), self.txid))
         inputs_amount = 0
-        for inp in self.inputs:
-            # get referenced UTXO
-            txid = inp.txid
-            pos = inp.pos
-            # get UTXO referenced by input
-            referenced_UTXO = utxo.consume(txid, pos)
+        for inp, entry in zip(self.inputs, spent):
+            # UTXO referenced by input (see lib/UTXO.py for its entries)
+            amount, created_UTXO_type, script_size, m, n = entry
             # get amount available in referenced UTXO
-            inputs_amount += referenced_UTXO.amount
+            inputs_amount += amount
             # determine spent UTXO type (pass input as well to identify nested segwig TX (P2SH-P2WPKH and P2SH-P2WSH)
             try:
-                inp.spent_UTXO_type = txout_type_solver(referenced_UTXO.script_pubkey, script_sig=inp.script_sig, witness=inp.witness)
+                inp.spent_UTXO_type = spent_type_solver(TXOUT_TYPE(created_UTXO_type), script_sig=inp.script_sig, witness=inp.witness)
             except:
                 raise Exception(f'error in {self.txid}')
-            inp.spent_UTXO_script = referenced_UTXO.script_pubkey
+            inp.spent_UTXO_size = script_size
+            inp.spent_UTXO_multisig = (m, n)
         # determine amount of all outputs
         outputs_amount = sum([output.amount for output in self.outputs])
         # determine fee
@@ -115,21 +128,97 @@ class Transaction:
             stripped_size = size 
 
 
-        # calculate txid, which is needed to record this transactions outputs
-        # in the UTXO set
+        # collect the data making up the txid, which is needed to record this
+        # transactions outputs in the UTXO set
         stream.seek(-size, 1)
-        tx_data = stream.read(size)
+        tx_data = memoryview(stream.read(size))
         if segwit == False:
-            txid = hash256(tx_data)[::-1]
+            txid_data = [tx_data]
         else:
             # legacy txid is calculated without:
             # 1. segwit marker and flag, which start after the four-byte version;
             # 2. witness data, which starts and ends at positions
             #    witness_start and witness_stop, respectively
-            txid = hash256(tx_data[0:4] + tx_data[6:witness_start] + tx_data[witness_stop:])[::-1]
+            txid_data = [tx_data[0:4], tx_data[6:witness_start], tx_data[witness_stop:]]
+
+        # create a Transaction object
+        return Transaction(version, segwit, inputs, outputs, locktime, size, stripped_size, txid_data)
+
+    @staticmethod
+    def from_buffer(buf, pos):
+        # same as deserialize(), but reads from an in-memory buffer starting at
+        # offset pos; returns Transaction object and offset after the tx
+        pos_start = pos
+
+        # version number (four bytes)
+        version = UINT32.unpack_from(buf, pos)[0]
+        pos += 4
+
+        # check for segwit marker (see deserialize())
+        if buf[pos] == 0:
+            # Marker found: segwit transaction
+            segwit = True
+            # Check segwit flag (currently, 0x01 must be used)
+            flag = buf[pos+1]
+            if flag != 1:
+                raise Exception('invalid segwit flag \'{}\''.format(bytes([flag])))
+            pos += 2
+        else:
+            # Marker not found: non-segwit transaction
+            segwit = False
+
+        # Deserialize inputs
+        num_inputs = buf[pos]
+        if num_inputs < 0xFD:
+            pos += 1
+        else:
+            num_inputs, pos = read_varint_from(buf, pos)
+        inputs = []
+        for i in range(num_inputs):
+            inp, pos = Input.from_buffer(buf, pos)
+            inputs.append(inp)
+
+        # Deserialize outputs
+        num_outputs = buf[pos]
+        if num_outputs < 0xFD:
+            pos += 1
+        else:
+            num_outputs, pos = read_varint_from(buf, pos)
+        outputs = []
+        for i in range(num_outputs):
+            output, pos = Output.from_buffer(buf, pos)
+            outputs.append(output)
+
+        # Handle SegWit
+        if segwit == True:
+            # Beginning of segwit data in tx
+            witness_start = pos - pos_start
+            for i in range(num_inputs):
+                inputs[i].witness, pos = Witness.from_buffer(buf, pos)
+            # End of segwit data in tx
+            witness_stop = pos - pos_start
+
+        # lock time (four bytes)
+        locktime = UINT32.unpack_from(buf, pos)[0]
+        pos += 4
+
+        # determine tx size
+        size = pos - pos_start
+
+        # determine stripped tx size
+        if segwit == True:
+            stripped_size = size - (witness_stop - witness_start) - 2 # two extra bytes are for segwit flags
+        else:
+            stripped_size = size
+
+        # collect the data making up the txid; no need to re-read the data, it
+        # is still in buf
+        if segwit == False:
+            txid_data = [buf[pos_start:pos]]
+        else:
+            # legacy txid is calculated without segwit marker, flag and
+            # witness data (see deserialize())
+            txid_data = [buf[pos_start:pos_start+4], buf[pos_start+6:pos_start+witness_start], buf[pos_start+witness_stop:pos]]
 
-        # store all of the tx's outputs in the UTXO set if not OP_RETURN
-        utxo.add(txid, outputs)
-    
         # create a Transaction object
-        return Transaction(version, segwit, inputs, outputs, locktime, size, stripped_size, txid)
+        return Transaction(version, segwit, inputs, outputs, locktime, size, stripped_size, txid_data), pos
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+
+from .tools import varint_size
+
+# Sidecar file recording the position of each tx within the serialized block
+# (relative to the start of the block), for all blocks with at least min_txs
+# txs. Knowing where the txs are, a block can be split into chunks that are
+# deserialized in parallel (see TxDecoder in lib/Pipeline.py). Positions are
+# appended to <filename>.dat as 32-bit little-endian integers while blocks
+# are processed; <filename>.npy is an index with one record per block,
+# written by save(). The block hash is stored along with each record, so
+# records of blocks that are no longer part of the active chain are ignored.
+TXOFFSETS_DTYPE = np.dtype([
+    ('height',  '<u4'),
+    ('hash',    'u1', 32),
+    ('start',   '<u8'),     # index of the block's first tx in <filename>.dat
+    ('ntx',     '<u4'),
+])
+
+class TxOffsets:
+
+    def __init__(self, filename, blockindex, min_txs=1000):
+        self.filename = filename
+        self.blockindex = blockindex
+        self.min_txs = min_txs
+        self.index = {}             # height -> block hash, start, number of txs
+        self.recorded = 0           # number of blocks recorded in this run
+        if os.path.exists(filename + '.npy'):
+            for record in np.load(filename + '.npy', allow_pickle=False):
+                self.index[int(record['height'])] = (record['hash'].tobytes(), int(record['start']), int(record['ntx']))
+
+        # data is appended after whatever is in the file; positions written
+        # after the index was last saved are not referenced and stay unused
+        self.file = open(filename + '.dat', 'ab')
+        self.size = self.file.tell() // 4
+        self.data = np.memmap(filename + '.dat', dtype='<u4', mode='r') if self.size > 0 else None
+
+    def get(self, height):
+        # return the positions of the txs in the block at height, or None if
+        # they are not known
+        record = self.index.get(height)
+        if record is None or self.data is None:
+            return None
+        blockhash, start, ntx = record
+        if blockhash != self.blockindex[height]['hash'].tobytes() or start + ntx > len(self.data):
+            return None
+        return self.data[start:start+ntx].tolist()
+
+    def record(self, height, block):
+        # record the positions of the txs of a deserialized block, unless
+        # they are known already or the block has too few txs; the txs
+        # follow the 80-byte header and the varint holding their number
+        blockhash = self.blockindex[height]['hash'].tobytes()
+        if block.ntx < self.min_txs or self.index.get(height, (None,))[0] == blockhash:
+            return
+        pos = 80 + varint_size(block.ntx)
+        offsets = []
+        for size in block.tx_sizes():
+            offsets.append(pos)
+            pos += size
+        self.file.write(np.array(offsets, dtype='<u4').tobytes())
+        self.index[height] = (blockhash, self.size, block.ntx)
+        self.size += block.ntx
+        self.recorded += 1
+
+    def save(self):
+        # write the index; positions are flushed first, so the index never
+        # refers to data that is not in the file
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        index = np.zeros(len(self.index), dtype=TXOFFSETS_DTYPE)
+        for pos, height in enumerate(sorted(self.index)):
+            blockhash, start, ntx = self.index[height]
+            index[pos] = (height, np.frombuffer(blockhash, dtype=np.uint8), start, ntx)
+        np.save(self.filename + '.tmp.npy', index, allow_pickle=False)
+        os.replace(self.filename + '.tmp.npy', self.filename + '.npy')
+
+    def close(self):
+        self.save()
+        self.file.close()
@@ -1,22 +1,162 @@
+import struct
+
 from .Constants import TXOUT_TYPE
 
+# UTXO set entry: amount, type determined when the UTXO was created
+# (TXOUT_TYPE value), size of its script_pubkey and m and n for bare multisig
+# scripts (0 otherwise). That's all the statistics need to know about a spent
+# UTXO; the script itself is not kept.
+ENTRY = struct.Struct('<QBIBB')
+
+def utxo_entry(amount, script_pubkey, created_UTXO_type):
+    # return the unpacked UTXO set entry for an output
+    m = n = 0
+    if created_UTXO_type == TXOUT_TYPE.MULTISIG:
+        m, n = script_pubkey.is_MULTISIG(params=True)
+    return amount, created_UTXO_type.value, script_pubkey.size(), m, n
+
+# outputs of the two coinbase txs that were created a second time while the
+# first one was still unspent, overwriting it (see BIP 30)
+DUPLICATE_OUTPOINTS = {bytes.fromhex(txid) + int.to_bytes(0, 4, 'big') for txid in [
+    'd5d27987d2a3dfc724e359870c6644b40e497bdc0589a033220fe15429d88599', # blocks 91812 and 91842
+    'e3bf3d07d4b0375638d5f1db5255fe07ba2c4cb067cd81b84ee974b6585fb468', # blocks 91722 and 91880
+]}
+
+# script sizes are grouped into buckets by their bit length: 0, 1, 2-3, 4-7,
+# ..., the last bucket holds all sizes of at least 2**(SIZE_BUCKETS-2)
+SIZE_BUCKETS = 17
+
+def size_bucket(size):
+    return min(size.bit_length(), SIZE_BUCKETS - 1)
+
+def size_bucket_name(bucket):
+    if bucket < 2:
+        return str(bucket)
+    if bucket == SIZE_BUCKETS - 1:
+        return '{}+'.format(2**(bucket-1))
+    return '{}-{}'.format(2**(bucket-1), 2**bucket - 1)
+
+class Aggregates:
+    # Running totals over the UTXO set: number of UTXOs, amount and script
+    # bytes per type, and number of UTXOs and amount per script size bucket.
+    # Updated whenever an entry is added or removed, so the set's composition
+    # is known at any time without scanning it.
+
+    def __init__(self):
+        self.count = [0] * len(TXOUT_TYPE)
+        self.amount = [0] * len(TXOUT_TYPE)
+        self.script_bytes = [0] * len(TXOUT_TYPE)
+        self.bucket_count = [0] * SIZE_BUCKETS
+        self.bucket_amount = [0] * SIZE_BUCKETS
+        self.added = 0      # number of entries added
+        self.removed = 0    # number of entries spent
+        self.replaced = 0   # number of entries overwritten (see BIP 30)
+
+    def update(self, entry, sign):
+        amount, created_UTXO_type, script_size, m, n = entry
+        bucket = size_bucket(script_size)
+        self.count[created_UTXO_type] += sign
+        self.amount[created_UTXO_type] += sign * amount
+        self.script_bytes[created_UTXO_type] += sign * script_size
+        self.bucket_count[bucket] += sign
+        self.bucket_amount[bucket] += sign * amount
+
+    def add(self, entry):
+        self.update(entry, 1)
+        self.added += 1
+
+    def remove(self, entry):
+        self.update(entry, -1)
+        self.removed += 1
+
+    def total(self):
+        return sum(self.count)
+
 class UTXO:
+    # UTXO set keyed by outpoint (txid + four-byte big-endian output position)
+    # and storing packed entries. This class keeps them in a Python dict;
+    # other backends override insert(), remove(), items(), clear() and
+    # __len__(). Entries added with store() and removed with consume() or
+    # consume_many() are accounted for in aggregates.
 
     def __init__(self):
         self.dict = {}
+        self.aggregates = Aggregates()
+
+    def insert(self, key, entry):
+        self.dict[key] = entry
+
+    def remove(self, key):
+        # return the packed entry stored under key and remove it
+        res = self.dict[key]
+        del self.dict[key]
+        return res
+
+    def remove_many(self, keys):
+        # remove the entries stored under keys (sorted outpoints, see
+        # Block.update_utxo()) and return a dict mapping each key to its packed
+        # entry; backends can resolve them in a single batch
+        return {key: self.remove(key) for key in keys}
+
+    def store(self, key, entry):
+        # add an unpacked entry (see utxo_entry())
+        if key in DUPLICATE_OUTPOINTS:
+            try:
+                self.aggregates.update(ENTRY.unpack(self.remove(key)), -1)
+                self.aggregates.replaced += 1
+            except KeyError:
+                pass
+        self.aggregates.add(entry)
+        self.insert(key, ENTRY.pack(*entry))
 
     def add(self, txid, outputs):
         for pos, output in enumerate(outputs):
             if output.created_UTXO_type == TXOUT_TYPE.OP_RETURN:
                 continue
             key = txid + int.to_bytes(pos, 4, 'big')
-            self.dict[key] = output
+            self.store(key, utxo_entry(output.amount, output.script_pubkey, output.created_UTXO_type))
 
     def consume(self, txid, pos):
+        # return the unpacked entry (see utxo_entry()) and remove it
         key = txid + int.to_bytes(pos, 4, 'big')
-        res = self.dict[key]
-        del self.dict[key]
-        return res
+        entry = ENTRY.unpack(self.remove(key))
+        self.aggregates.remove(entry)
+        return entry
+
+    def consume_many(self, keys):
+        # same as consume() for a sorted list of keys; returns a dict mapping
+        # each key to its unpacked entry
+        entries = {}
+        for key, entry in self.remove_many(keys).items():
+            entry = ENTRY.unpack(entry)
+            self.aggregates.remove(entry)
+            entries[key] = entry
+        return entries
+
+    def update(self, spent_keys, created):
+        # apply a block: consume the entries stored under spent_keys (sorted)
+        # and store the created ones (dict mapping keys to unpacked entries);
+        # returns the consumed entries like consume_many()
+        resolved = self.consume_many(spent_keys)
+        for key, entry in created.items():
+            self.store(key, entry)
+        return resolved
+
+    def items(self):
+        # iterate over all (key, packed entry) pairs
+        return iter(self.dict.items())
+
+    def advance(self, height):
+        # called after the block at height has been connected
+        pass
 
     def clear(self):
         self.dict.clear()
+        self.aggregates = Aggregates()
+
+    def __len__(self):
+        return len(self.dict)
+
+    def stats(self):
+        # summary for the progress output of parse_blockchain.py
+        return 'UTXO set: {} entries'.format(len(self))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+from .Coin import Coin
+from .tools import read_varint_from
+
+def read_block_undo(buf):
+    # Deserialize a block's undo data as stored in rev*.dat (CBlockUndo in
+    # Bitcoin Core's src/undo.h): for every transaction but the coinbase, the
+    # coins spent by its inputs, in input order. Returns a list containing one
+    # list of Coin objects per non-coinbase transaction.
+    buf = memoryview(buf)
+    num_txs, pos = read_varint_from(buf, 0)
+    undo = []
+    for i in range(num_txs):
+        num_coins, pos = read_varint_from(buf, pos)
+        coins = []
+        for j in range(num_coins):
+            coin, pos = Coin.from_buffer(buf, pos, undo=True)
+            coins.append(coin)
+        undo.append(coins)
+
+    # there must not be any data left after deserialization
+    if pos != len(buf):
+        raise Exception('{} bytes left in undo data after deserialization'.format(len(buf) - pos))
+    return undo
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from .tools import read_varint
+from .tools import read_varint, read_varint_from
 from .Script import Script
 
 class Witness:
@@ -45,3 +45,27 @@ class Witness:
         size = stream.tell() - pos_start
         # create and return Witness object
         return Witness(items, size)
+
+    @staticmethod
+    def from_buffer(buf, pos):
+        # same as deserialize(), but reads from an in-memory buffer starting at
+        # offset pos; returns Witness object and offset after the witness
+        pos_start = pos
+        num_items = buf[pos]
+        if num_items < 0xFD:
+            pos += 1
+        else:
+            num_items, pos = read_varint_from(buf, pos)
+        if num_items == 0:
+            return None, pos
+        items = []
+        for i in range(num_items):
+            len_item = buf[pos]
+            if len_item < 0xFD:
+                pos += 1
+            else:
+                len_item, pos = read_varint_from(buf, pos)
+            items.append(buf[pos:pos+len_item])
+            pos += len_item
+        # create and return Witness object
+        return Witness(items, pos - pos_start), pos
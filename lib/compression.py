@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Decompression of amounts and scripts as stored by Bitcoin Core in undo data
+# (rev*.dat) and the chainstate; see Bitcoin Core's src/compressor.{h,cpp}
+
+from .tools import read_core_varint
+from .Constants import OP_DUP, OP_HASH160, OP_EQUAL, OP_EQUALVERIFY, OP_CHECKSIG, OP_RETURN
+
+# number of special script types (P2PKH, P2SH, P2CPK (two), P2UPK (two))
+NUM_SPECIAL_SCRIPTS = 6
+MAX_SCRIPT_SIZE = 10000
+
+# secp256k1 field size, needed to decompress public keys
+SECP256K1_P = 2**256 - 2**32 - 977
+
+def decompress_amount(x):
+    # see DecompressAmount in Bitcoin Core's src/compressor.cpp
+    if x == 0:
+        return 0
+    x -= 1
+    # x = 10*(9*n + d - 1) + e
+    e = x % 10
+    x //= 10
+    if e < 9:
+        # x = 9*n + d - 1
+        d = (x % 9) + 1
+        x //= 9
+        # x = n
+        n = x*10 + d
+    else:
+        n = x + 1
+    while e:
+        n *= 10
+        e -= 1
+    return n
+
+def decompress_pubkey(prefix, x_bytes):
+    # recover the y coordinate from a compressed public key (prefix 0x02 for
+    # even y, 0x03 for odd y) and return the uncompressed 65-byte key
+    x = int.from_bytes(x_bytes, 'big')
+    y = pow((pow(x, 3, SECP256K1_P) + 7) % SECP256K1_P, (SECP256K1_P + 1) // 4, SECP256K1_P)
+    if y & 1 != prefix & 1:
+        y = SECP256K1_P - y
+    return b'\x04' + bytes(x_bytes) + y.to_bytes(32, 'big')
+
+def read_compressed_script(buf, pos):
+    # decode a compressed script at buf[pos], return script and position
+    # after the script; see ScriptCompression in Bitcoin Core's
+    # src/compressor.h
+    size, pos = read_core_varint(buf, pos)
+
+    # P2PKH: 20-byte key hash
+    if size == 0:
+        return bytes([OP_DUP, OP_HASH160, 20]) + bytes(buf[pos:pos+20]) + bytes([OP_EQUALVERIFY, OP_CHECKSIG]), pos+20
+    # P2SH: 20-byte script hash
+    if size == 1:
+        return bytes([OP_HASH160, 20]) + bytes(buf[pos:pos+20]) + bytes([OP_EQUAL]), pos+20
+    # P2CPK: x coordinate of compressed key, size is the key's prefix
+    if size in (2, 3):
+        return bytes([33, size]) + bytes(buf[pos:pos+32]) + bytes([OP_CHECKSIG]), pos+32
+    # P2UPK: stored as compressed key, size minus two is the key's prefix
+    if size in (4, 5):
+        return bytes([65]) + decompress_pubkey(size - 2, buf[pos:pos+32]) + bytes([OP_CHECKSIG]), pos+32
+
+    # any other script is stored as is
+    size -= NUM_SPECIAL_SCRIPTS
+    if size > MAX_SCRIPT_SIZE:
+        # overly long scripts are unspendable and replaced by OP_RETURN
+        return bytes([OP_RETURN]), pos+size
+    return bytes(buf[pos:pos+size]), pos+size
+
+def read_compressed_txout(buf, pos):
+    # decode a compressed amount followed by a compressed script, return
+    # amount, script and position after the script; see TxOutCompression in
+    # Bitcoin Core's src/compressor.h
+    amount, pos = read_core_varint(buf, pos)
+    script, pos = read_compressed_script(buf, pos)
+    return decompress_amount(amount), script, pos
@@ -1,7 +1,38 @@
 from .UTXO import UTXO
+from .HashTableUTXO import HashTableUTXO
+from .GenerationalUTXO import GenerationalUTXO
+from .ShardedUTXO import ShardedUTXO
 from .Logger import Logger
 
-utxo = UTXO()
+# UTXO set backend:
+# 'dict':         Python dict (see lib/UTXO.py)
+# 'hashtable':    open addressing hash table in NumPy arrays (see
+#                 lib/HashTableUTXO.py)
+# 'disk':         LevelDB database in utxo_path with a write-back cache of
+#                 utxo_cache_bytes (see lib/DiskUTXO.py)
+# 'generational': dicts for new UTXOs, sorted array for old ones (see
+#                 lib/GenerationalUTXO.py)
+# 'sharded':      split across utxo_shards worker processes (see
+#                 lib/ShardedUTXO.py)
+utxo_backend = 'dict'
+utxo_path = 'utxo-db'
+utxo_cache_bytes = 4*1024**3
+utxo_shards = 4
+
+# utxo and log are not thread-safe: only the thread connecting blocks and
+# collecting statistics may use them (see ThreadDecodePool in lib/Pipeline.py)
+if utxo_backend == 'hashtable':
+    utxo = HashTableUTXO()
+elif utxo_backend == 'sharded':
+    utxo = ShardedUTXO(utxo_shards)
+elif utxo_backend == 'generational':
+    utxo = GenerationalUTXO()
+elif utxo_backend == 'disk':
+    # plyvel is only needed for this backend
+    from .DiskUTXO import DiskUTXO
+    utxo = DiskUTXO(utxo_path, utxo_cache_bytes)
+else:
+    utxo = UTXO()
 log = Logger()
 
 window_sizes = [
@@ -1,11 +1,13 @@
 import numpy as np
 np.seterr(all='raise')
 from .globals import log
+from .globals import utxo
 from .globals import window_sizes
 from .tools import max_block_subsidy
 from .Constants import TXOUT_TYPE
+from .UTXO import SIZE_BUCKETS, size_bucket_name
 
-def process(b, height, window):
+def process(b, height, window, undo=False):
     amount_transferred(b, window)
     inputs_and_outputs(b, window)
     spent_UTXO_types(b, window)
@@ -13,11 +15,58 @@ def process(b, height, window):
     tx_count_size_weight(b, window)
     fees_and_subsidy(b, window, height)
     block_meta(b, window)
+    utxo_flow(b)
 
     # write results if necessary
     for window_size in window_sizes:
         if (height + 1) % window_size == 0:
             window.process(height, window_size)
+            # no UTXO set when using undo data
+            if not undo:
+                utxo_set(height, window_size)
+
+# UTXOs created and spent by blocks since the UTXO set was last checked, and
+# number of UTXOs added minus number of UTXOs spent according to the UTXO
+# set's aggregates at that point; stored in checkpoints
+flow = {'created': 0, 'spent': 0, 'last': None}
+
+def utxo_flow(block):
+    flow['created'] += sum(1 for tx in block.transactions for output in tx.outputs if output.created_UTXO_type != TXOUT_TYPE.OP_RETURN)
+    flow['spent'] += sum(len(tx.inputs) for tx in block.transactions[1:])
+
+def check_utxo_set():
+    # the aggregates must add up to the size of the UTXO set, and the UTXO
+    # set must have changed by the number of UTXOs created minus the number of
+    # UTXOs spent since the last check
+    aggregates = utxo.aggregates
+    total = aggregates.total()
+    if total != len(utxo) or total != sum(aggregates.bucket_count) or total != aggregates.added - aggregates.removed - aggregates.replaced:
+        raise Exception('UTXO set aggregates inconsistent: {} UTXOs per type, {} per size bucket, {} added, {} removed, {} replaced, but UTXO set has {} entries'.format(total, sum(aggregates.bucket_count), aggregates.added, aggregates.removed, aggregates.replaced, len(utxo)))
+    net = aggregates.added - aggregates.removed
+    if flow['last'] is not None and net - flow['last'] != flow['created'] - flow['spent']:
+        raise Exception('UTXO set changed by {} entries, but blocks created {} and spent {} UTXOs'.format(net - flow['last'], flow['created'], flow['spent']))
+    flow['created'] = flow['spent'] = 0
+    flow['last'] = net
+
+# types a UTXO can have when it is created (see txout_type_solver())
+UTXO_SET_TYPES = [TXOUT_TYPE.P2UPK, TXOUT_TYPE.P2CPK, TXOUT_TYPE.P2PKH, TXOUT_TYPE.P2SH, TXOUT_TYPE.MULTISIG, TXOUT_TYPE.P2WPKH, TXOUT_TYPE.P2WSH, TXOUT_TYPE.P2W_UNKNOWN, TXOUT_TYPE.NONSTANDARD]
+
+# composition of the UTXO set
+def utxo_set(height, window_size):
+    aggregates = utxo.aggregates
+    if window_size == window_sizes[0]:
+        check_utxo_set()
+
+    data = {'height': height}
+    for txout_type in UTXO_SET_TYPES:
+        data[f'{txout_type.name}_count'] = aggregates.count[txout_type.value]
+        data[f'{txout_type.name}_amount'] = aggregates.amount[txout_type.value]
+        data[f'{txout_type.name}_script_bytes'] = aggregates.script_bytes[txout_type.value]
+    for bucket in range(SIZE_BUCKETS):
+        name = size_bucket_name(bucket)
+        data[f'size_{name}_count'] = aggregates.bucket_count[bucket]
+        data[f'size_{name}_amount'] = aggregates.bucket_amount[bucket]
+    log.write(f'utxo_set-{window_size}', data)
 
 # Amount transferred per tx, per block
 def amount_transferred(block, window):
@@ -68,7 +117,7 @@ def spent_UTXO_types(block, window):
 
             # extract m and n for multisig
             if spent_UTXO_type == TXOUT_TYPE.MULTISIG:
-                m, n = inp.spent_UTXO_script.is_MULTISIG(params=True)
+                m, n = inp.spent_UTXO_multisig
                 target += f'-{m}-of-{n}'
             if spent_UTXO_type == TXOUT_TYPE.P2SH_MULTISIG:
                 m, n = inp.script_sig.get_redeem_script().is_MULTISIG(params=True)
@@ -82,9 +131,9 @@ def spent_UTXO_types(block, window):
 
             # record in histogram
             log.hist(f'input_{target}', {'script_sig': inp.script_sig.size(),
-                                         'spent_UTXO_script_pubkey': 0 if spent_UTXO_type == TXOUT_TYPE.COINBASE else inp.spent_UTXO_script.size(),
+                                         'spent_UTXO_script_pubkey': 0 if spent_UTXO_type == TXOUT_TYPE.COINBASE else inp.spent_UTXO_size,
                                          'witness': 0 if inp.witness == None else inp.witness.size,
-                                         'sum_scripts_and_witness': inp.script_sig.size() + (0 if spent_UTXO_type == TXOUT_TYPE.COINBASE else inp.spent_UTXO_script.size()) + (0 if inp.witness == None else inp.witness.size),
+                                         'sum_scripts_and_witness': inp.script_sig.size() + (0 if spent_UTXO_type == TXOUT_TYPE.COINBASE else inp.spent_UTXO_size) + (0 if inp.witness == None else inp.witness.size),
                                          'total': inp.size})
 
             # initialize or increment counter
@@ -1,11 +1,32 @@
 #!/usr/bin/env python3
 
 import sys
+import struct
 from hashlib import sha256
 
+# precompiled structs for fixed-size little-endian fields
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+
 def hash256(data):
     return sha256(sha256(data).digest()).digest()
 
+def hash256_many(items):
+    # double SHA-256 of several messages in one call, e.g., all txids of a
+    # block. Each item is a list of buffer segments (memoryview slices into
+    # the block) that are hashed as if they were concatenated, so no joined
+    # copy is ever made. hashlib releases the GIL while updating with
+    # segments of 2 KiB or more, so other threads can run while large
+    # transactions are hashed.
+    digests = []
+    for segments in items:
+        h = sha256()
+        for segment in segments:
+            h.update(segment)
+        digests.append(sha256(h.digest()).digest())
+    return digests
+
 def hash160(data):
     return hashlib.new('ripemd160', hashlib.sha256(data).digest()).digest()
 
@@ -41,3 +62,46 @@ def read_varint(stream):
         return int.from_bytes(stream.read(4), 'little')
     elif (value == 0xFF):
         return int.from_bytes(stream.read(8), 'little')
+
+def read_varint_from(buf, pos):
+    # decode varint at buf[pos], return value and position after the varint;
+    # callers handle the common single-byte case inline and only call this
+    # function for larger values
+    value = buf[pos]
+
+    if (value < 0xFD):
+        return value, pos+1
+    elif (value == 0xFD):
+        return UINT16.unpack_from(buf, pos+1)[0], pos+3
+    elif (value == 0xFE):
+        return UINT32.unpack_from(buf, pos+1)[0], pos+5
+    elif (value == 0xFF):
+        return UINT64.unpack_from(buf, pos+1)[0], pos+9
+
+def varint_size(value):
+    # number of bytes taken by value encoded as varint
+    if value < 0xFD:
+        return 1
+    if value <= 0xFFFF:
+        return 3
+    if value <= 0xFFFFFFFF:
+        return 5
+    return 9
+
+def read_core_varint(buf, pos):
+    # decode Bitcoin Core's alternative varint format (used in the block
+    # index, undo data and the chainstate) at buf[pos], return value and
+    # position after the varint; see ReadVarInt in Bitcoin Core's
+    # src/serialize.h for details
+    value = 0
+    while True:
+        data = buf[pos]
+        pos += 1
+        # data is in lower seven bits
+        value = (value << 7) | (data & 0x7f)
+        # if the most significant bit is not set, we stop
+        if data & 0x80 == 0:
+            return value, pos
+        # each continuation byte also adds one, so that there is exactly one
+        # encoding per value
+        value += 1
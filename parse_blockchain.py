@@ -4,14 +4,23 @@ import sys
 import pickle
 import time
 import os
+import argparse
 import psutil
+import numpy as np
 
-from lib.Block import Block
+from lib.BlockReader import BlockReader, MmapBlockReader, SequentialScheduler, read_blocks
+from lib import BlockIndex
+from lib import Checkpoint
+from lib import Ranges
+from lib.Prefetcher import Prefetcher
+from lib.Pipeline import DecodePool, ThreadDecodePool, TxDecoder, decode_blocks, decode_threads, gil_enabled
+from lib.TxOffsets import TxOffsets
+from lib.BlockRing import RingDecodePool
 from lib.Window import Window
 from lib.globals import utxo
 from lib.globals import log
 from lib.globals import window_sizes
-from lib.statistics import process
+from lib.statistics import process, flow
 
 MIN_PYTHON = (3, 7) # ordered dictionaries
 if sys.version_info < MIN_PYTHON:
@@ -20,30 +29,120 @@ if sys.version_info < MIN_PYTHON:
 rows, columns = [int(x) for x in os.popen('stty size', 'r').read().split()]
 
 datadir = '/scratch/bitcoin-0.19.0.1-datadir/'
-indexdb = 'blockindex.pdb'
-MAGIC = bytes.fromhex('d9b4bef9')
+indexdb = 'blockindex.npy'
+# read blocks from memory-mapped blk*.dat files ('mmap') or using buffered
+# file reads ('file')
+READER = 'mmap'
+# deserialize blocks from a file-like stream ('stream') or directly from the
+# block's buffer using explicit offsets ('buffer')
+PARSER = 'buffer'
+# take spent UTXOs from Bitcoin Core's undo data (rev*.dat) instead of keeping
+# a UTXO set in memory
+UNDO = False
+# read blocks in height order ('height') or each blk*.dat file sequentially
+# ('file'); in the latter case, blocks are put back into height order using a
+# reorder buffer holding up to REORDER_CAPACITY blocks and REORDER_BYTES bytes
+READ_ORDER = 'file'
+REORDER_CAPACITY = 1024
+REORDER_BYTES = 256*1024*1024
+# read blocks in a background thread; the prefetch queue holds at most
+# PREFETCH_DEPTH blocks and PREFETCH_BYTES bytes
+PREFETCH = True
+PREFETCH_DEPTH = 64
+PREFETCH_BYTES = 256*1024*1024
+# write a checkpoint of the complete state (UTXO set, windows, histograms,
+# output files) to CHECKPOINT_DIR every CHECKPOINT_INTERVAL blocks; run with
+# --resume to continue from the last one
+CHECKPOINT = True
+CHECKPOINT_DIR = 'checkpoints'
+CHECKPOINT_INTERVAL = 10000
+# start with the UTXO set in a copy of Bitcoin Core's chainstate/ directory
+# instead of at the genesis block (None to disable); blocks up to the
+# chainstate's best block are skipped, and statistics are only collected from
+# the next height that is a multiple of the largest window size on
+CHAINSTATE = None
+# deserialize blocks (and undo data) in DECODE_PROCESSES worker processes
+# (0 to deserialize them in this process, None to use one per CPU); UTXO set
+# updates, fees, spent UTXO types and statistics are still handled one block
+# after the other in this process. Blocks are sent to the workers in batches
+# of about DECODE_BATCH_BYTES bytes, with at most DECODE_DEPTH batches in
+# flight (None for two per worker).
+DECODE_PROCESSES = 0
+DECODE_BATCH_BYTES = 4*1024*1024
+DECODE_DEPTH = None
+# return decoded blocks from the workers by pickling them ('pickle') or through
+# ring buffers of DECODE_RING_BYTES bytes in shared memory ('shm', see
+# lib/BlockRing.py)
+DECODE_TRANSPORT = 'shm'
+DECODE_RING_BYTES = 64*1024*1024
+# deserialize blocks in DECODE_THREADS worker threads instead (None for one per
+# CPU but one, 0 to disable); this avoids pickling blocks and starting
+# processes, but threads only decode in parallel in a free-threaded build of
+# Python running without the GIL. With the GIL, this setting is ignored and
+# DECODE_PROCESSES applies. The UTXO set and statistics are only ever used by
+# the main thread.
+DECODE_THREADS = None
+# record the position of each tx of blocks with at least TX_OFFSETS_MIN_TXS txs
+# in the sidecar files TX_OFFSETS.dat and TX_OFFSETS.npy (None to disable, see
+# lib/TxOffsets.py). On later runs, the txs of these blocks are deserialized
+# in chunks by INTRA_BLOCK_WORKERS threads (None for one per CPU, 0 to
+# disable) if Python is running without the GIL; with the GIL, positions are
+# still recorded, but blocks are decoded as usual. This only applies to blocks
+# decoded in this process, i.e., not with DECODE_PROCESSES or DECODE_THREADS.
+TX_OFFSETS = None
+TX_OFFSETS_MIN_TXS = 1000
+INTRA_BLOCK_WORKERS = None
+# with undo data, process the chain in independent ranges of about RANGE_SIZE
+# blocks (rounded up to a multiple of the largest window size) in
+# RANGE_PROCESSES worker processes (0 to disable, None to use one per CPU);
+# each range's output is merged into a single output directory, which ends
+# up identical to the output of processing all blocks one after the other.
+# Checkpoints are not written in this mode.
+RANGE_PROCESSES = 0
+RANGE_SIZE = 25*432
 
-# read array containing sorted block hashes of active chain
-with open(indexdb, 'rb') as fp:
-    blockindex = pickle.load(fp)
+parser = argparse.ArgumentParser()
+parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint in {}'.format(CHECKPOINT_DIR))
+args = parser.parse_args()
+
+if RANGE_PROCESSES != 0 and not UNDO:
+    raise Exception('processing ranges in parallel requires undo data (UNDO = True)')
+if RANGE_PROCESSES != 0 and args.resume:
+    raise Exception('processing ranges in parallel cannot be resumed from a checkpoint')
+
+# start the workers right away, while this process is still small
+# and has no other threads
+pool = None
+threads = decode_threads(DECODE_THREADS) if RANGE_PROCESSES == 0 else 0
+if threads != 0:
+    print('GIL disabled, decoding blocks in {} threads'.format(threads))
+    pool = ThreadDecodePool(threads, DECODE_DEPTH, DECODE_BATCH_BYTES, parser=PARSER, undo=UNDO)
+elif DECODE_PROCESSES != 0 and RANGE_PROCESSES == 0:
+    if DECODE_THREADS != 0 and gil_enabled():
+        print('GIL enabled, decoding blocks in processes instead of threads')
+    if DECODE_TRANSPORT == 'shm':
+        pool = RingDecodePool(DECODE_PROCESSES, DECODE_DEPTH, DECODE_BATCH_BYTES, DECODE_RING_BYTES, parser=PARSER, undo=UNDO)
+    else:
+        pool = DecodePool(DECODE_PROCESSES, DECODE_DEPTH, DECODE_BATCH_BYTES, parser=PARSER, undo=UNDO)
+decoder = None
+if pool is None and RANGE_PROCESSES == 0 and TX_OFFSETS is not None and INTRA_BLOCK_WORKERS != 0 and not gil_enabled() and os.path.exists(TX_OFFSETS + '.npy'):
+    decoder = TxDecoder(INTRA_BLOCK_WORKERS)
+
+# read (memory-map) array containing block index of active chain
+blockindex = BlockIndex.load(indexdb)
 
 # blockindex is an ordered array with position corresponding block number;
-# its elements are dictionaries, each of which has the following entries:
+# its elements are records (see lib/BlockIndex.py), each of which has the
+# following fields:
 #
-# blockhash: the block's hash
-# version: the block's version
 # height: the block's height
 # status: the block's status
 # ntx: the number of transactions recorded in the block
-# fileno (if applicable): file number where the block's contents are stored
-# datapos (if applicable): position in the file where the block's contents are stored
-# undopos (if applicable): position in the file where the block's undo info is stored
-# blockver: the block's version number
-# hash_prev_block: the hash of the block's parent
-# merkle_root: the block's merkle root
-# timestamp: the block's timestamp
-# diffuculty: the block's difficulty bits
-# nonce: the block's nonce
+# fileno (-1 if not applicable): file number where the block's contents are stored
+# datapos (-1 if not applicable): position in the file where the block's contents are stored
+# undopos (-1 if not applicable): position in the file where the block's undo info is stored
+# hash: the block's hash (32 bytes)
+# header: the block's header (80 bytes)
 
 # Iterate over all blocks
 # Open file, seek to position, validate block magic (there's a magic number, 0xD9B4BEF9, at the beginning of each block in the block chain format used by bitcoin core)
@@ -53,59 +152,85 @@ chain_size = 300    # size of block chain [GB]
 
 start = time.time()
 tip = len(blockindex)
-fps = {} # dict for file pointers
 
 window = Window(window_sizes)
 
+# positions of the txs in large blocks, recorded in earlier runs
+tx_offsets = TxOffsets(TX_OFFSETS, blockindex, TX_OFFSETS_MIN_TXS) if TX_OFFSETS is not None and RANGE_PROCESSES == 0 else None
+
+# restore state after the last checkpointed block; otherwise, start with an
+# empty UTXO set (this discards the database of the 'disk' backend, see
+# lib/globals.py)
+first = 0
+stats_start = 0
+if not args.resume and not UNDO:
+    utxo.clear()
+if args.resume:
+    height, (chain_done, stats_start, checked_flow) = Checkpoint.load(CHECKPOINT_DIR, utxo, window, log)
+    flow.update(checked_flow)
+    first = height + 1
+    print('resuming at block {} from checkpoint in {}'.format(first, CHECKPOINT_DIR))
+elif CHAINSTATE is not None:
+    # plyvel is only needed here
+    from lib import Chainstate
+    # the UTXO set is not needed with undo data
+    best_block, count = Chainstate.load(CHAINSTATE, utxo, coins=not UNDO)
+    match = (blockindex['hash'] == np.frombuffer(best_block, dtype=np.uint8)).all(axis=1).nonzero()[0]
+    if len(match) == 0:
+        raise Exception('best block {} of chainstate not in block index'.format(best_block[::-1].hex()))
+    first = int(match[0]) + 1
+    stats_start = -(-first // max(window_sizes)) * max(window_sizes)
+    print('loaded {} UTXOs from chainstate, starting at block {}, collecting statistics from block {} on'.format(count, first, stats_start))
+resumed_done = chain_done
 
-for height, block in enumerate(blockindex):
+# process ranges in parallel and finish
+if RANGE_PROCESSES != 0:
+    ranges = Ranges.split(stats_start, tip, RANGE_SIZE)
+    for done, (first, stop, size) in enumerate(Ranges.run(datadir, indexdb, ranges, RANGE_PROCESSES, PARSER), 1):
+        chain_done += size / (1024**3)
+        print('blocks {} to {} done ({}/{} ranges), elapsed time {:.1f}h, processed {:.1f}/{:.1f}GB ({:.1f}%)'.format(first, stop-1, done, len(ranges), (time.time()-start)/3600, chain_done, chain_size, chain_done/chain_size*100.0))
+    print('processed {} blocks in {:.1f}s'.format(tip - stats_start, time.time()-start))
+    log.write_histograms()
+    log.compress()
+    sys.exit()
 
-    fileno = block['fileno']
-    filename = datadir + '/blocks/blk{:05}.dat'.format(fileno)
+if READER == 'mmap':
+    reader = MmapBlockReader(datadir)
+else:
+    reader = BlockReader(datadir)
 
-    # Put a limit on the number of open files (eight)
-    # Check if file already open using dict. if not, open it, put handle in dict
-    if fileno in fps:
-        f = fps[fileno]
+# serialized blocks in height order; depending on the reader, each one is
+# either a bytes object or a memoryview into the memory-mapped blk*.dat file
+if READ_ORDER == 'file':
+    scheduler = SequentialScheduler(reader, blockindex, REORDER_CAPACITY, undo=UNDO, start=first, max_bytes=REORDER_BYTES)
+    blocks = scheduler
+else:
+    blocks = read_blocks(reader, blockindex, undo=UNDO, start=first)
+if PREFETCH:
+    blocks = Prefetcher(blocks, PREFETCH_DEPTH, PREFETCH_BYTES)
+
+# deserialized blocks (see lib/Pipeline.py), still in height order
+if pool is not None:
+    decoded = pool.map(blocks)
+else:
+    decoded = decode_blocks(blocks, parser=PARSER, undo=UNDO, tx_offsets=tx_offsets, decoder=decoder)
+
+for height, b, spent in decoded:
+
+    if tx_offsets is not None:
+        tx_offsets.record(height, b)
+
+    # determine fees and spent UTXO types, either using the UTXO set or the
+    # UTXOs spent according to the block's undo data
+    if UNDO:
+        b.connect(spent=spent)
     else:
-        # Make sure there are a maximum of eight open files
-        # To this end, discard smallest first item in dict, which corresponds
-        # to the oldest one (Python >=3.7 has ordered dicts)
-        if len(fps) == 8:
-            remove = list(fps.keys())[0]
-            remove_fp = fps.pop(remove, None)
-            remove_fp.close()
-        # Use a ten-megabyte buffer
-        f = open(filename, 'rb', 10*1024*1024)
-        fps[fileno] = f
-
-    # move to correct position in file
-    # datapos points to block header, we rewind by two times four bytes to
-    # make it point to magic (four bytes), block size (four bytes), block
-    # header
-    datapos = block['datapos']
-    f.seek(datapos-8)
-
-    # read four bytes magic
-    magic = f.read(4)[::-1]
-    if magic != MAGIC:
-        raise Exception('Error: Block magic not found! (read {}, should be {})'.format(magic, MAGIC))
-
-    # read four-byte integer corresponding to the block size
-    blocksize_raw = f.read(4)
-    blocksize = int.from_bytes(blocksize_raw, 'little')
-    pos_start = f.tell()
-
-    # deserialize Block
-    b = Block.deserialize(f)
-
-    # there must not be any data left in the block's Stream after it has been
-    # deserialized
-    if f.tell() - pos_start != blocksize:
-        raise Exception('{} bytes left in serialized stream after deserialization !'.format(stream.bytes_left()))
+        b.connect()
+        utxo.advance(height)
 
     # Do processing
-    process(b, height, window)
+    if height >= stats_start:
+        process(b, height, window, undo=UNDO)
 
     # add amount of processed bytes for calculation of remaining runtime
     chain_done += b.size / (1024**3)
@@ -114,13 +239,50 @@ for height, block in enumerate(blockindex):
     if (height > 0 and height % 10000 == 0):
         # determine remaining runtime: [work left in GB] * [runtime per GB]
         runtime = time.time() - start
-        time_left = (chain_size-chain_done) * (runtime / chain_done)
+        time_left = (chain_size-chain_done) * (runtime / (chain_done-resumed_done))
         rss_GB = psutil.Process().memory_full_info().rss / (1024 ** 3)
         rss_perc = psutil.Process().memory_percent(memtype='rss')
-        print('block {}/{}, elapsed time {:.1f}h, processed {:.1f}/{:.1f}GB ({:.1f}%), remaining time: {:.1f}h, number of open files: {}, block time: {}, mem. usage: {:.1f}GB ({:.1f}% of total)'.format(height, tip, runtime/3600, chain_done, chain_size, chain_done/chain_size*100.0, time_left/3600, len(fps), b.get_timestamp(), rss_GB, rss_perc))
+        print('block {}/{}, elapsed time {:.1f}h, processed {:.1f}/{:.1f}GB ({:.1f}%), remaining time: {:.1f}h, number of open files: {}, block time: {}, mem. usage: {:.1f}GB ({:.1f}% of total)'.format(height, tip, runtime/3600, chain_done, chain_size, chain_done/chain_size*100.0, time_left/3600, len(reader.files), b.get_timestamp(), rss_GB, rss_perc))
+        if READ_ORDER == 'file':
+            print('reorder buffer: {} blocks, {:.1f}MB (max. {}, {:.1f}MB), blocks read out of file order: {}, files reopened: {}'.format(len(scheduler.buffer), scheduler.bytes / (1024**2), scheduler.max_occupancy, scheduler.max_bytes_used / (1024**2), scheduler.direct_reads, reader.reopened))
+        else:
+            print('files reopened: {}'.format(reader.reopened))
+        if PREFETCH:
+            print('prefetch queue: {} blocks, {:.1f}MB'.format(len(blocks.queue), blocks.bytes / (1024**2)))
+        if pool is not None:
+            print('decoding: {} workers, {} batches, max. {} batches in flight'.format(pool.processes, pool.batches, pool.max_pending))
+            if isinstance(pool, RingDecodePool):
+                print(pool.stats())
+        if tx_offsets is not None:
+            print('tx offsets: {} blocks known, {} recorded, {} decoded in chunks'.format(len(tx_offsets.index), tx_offsets.recorded, decoder.blocks if decoder is not None else 0))
+        if not UNDO:
+            print(utxo.stats())
+
+    # write checkpoint; chain_done, stats_start and the UTXO flow since the
+    # last check of the UTXO set (see lib/statistics.py) are stored along
+    # with it
+    if CHECKPOINT and height > 0 and height % CHECKPOINT_INTERVAL == 0:
+        Checkpoint.save(CHECKPOINT_DIR, height, utxo, window, log, (chain_done, stats_start, dict(flow)))
+        if tx_offsets is not None:
+            tx_offsets.save()
 
+if pool is not None:
+    if isinstance(pool, RingDecodePool):
+        print(pool.stats())
+    # the last block may still refer to a ring buffer
+    b = spent = None
+    pool.close()
+if decoder is not None:
+    decoder.close()
+if tx_offsets is not None:
+    tx_offsets.close()
+reader.close()
 stop = time.time()
 print('processed {} blocks in {:.1f}s'.format(tip+1, stop-start))
+if READ_ORDER == 'file':
+    print('max. reorder buffer occupancy: {} blocks, {:.1f}MB, blocks read out of file order: {}, files reopened: {}'.format(scheduler.max_occupancy, scheduler.max_bytes_used / (1024**2), scheduler.direct_reads, reader.reopened))
+else:
+    print('files reopened: {}'.format(reader.reopened))
 log.write_histograms()
 log.compress()
 
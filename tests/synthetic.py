@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Build serialized blocks and undo data (as stored in blk*.dat and rev*.dat)
+# from made-up txs, so the decoders can be tested without a datadir. The
+# blocks are well-formed but not valid: hashes, keys and signatures are
+# random bytes.
+
+import os
+import random
+import struct
+
+from lib.Constants import OP_DUP, OP_HASH160, OP_EQUAL, OP_EQUALVERIFY, OP_CHECKSIG, OP_RETURN, OP_0, OP_1, OP_CHECKMULTISIG
+
+def varint(n):
+    if n < 0xFD:
+        return bytes([n])
+    if n <= 0xFFFF:
+        return b'\xfd' + struct.pack('<H', n)
+    if n <= 0xFFFFFFFF:
+        return b'\xfe' + struct.pack('<I', n)
+    return b'\xff' + struct.pack('<Q', n)
+
+def core_varint(n):
+    # see WriteVarInt in Bitcoin Core's src/serialize.h
+    data = [n & 0x7f]
+    while n > 0x7f:
+        n = (n >> 7) - 1
+        data.append((n & 0x7f) | 0x80)
+    return bytes(reversed(data))
+
+def compress_amount(n):
+    # see CompressAmount in Bitcoin Core's src/compressor.cpp
+    if n == 0:
+        return 0
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n*9 + d - 1)*10 + e
+    return 1 + (n - 1)*10 + 9
+
+def push(data):
+    return bytes([len(data)]) + data
+
+def script_pubkey(rng, kind):
+    if kind == 'p2pkh':
+        return bytes([OP_DUP, OP_HASH160]) + push(rng.randbytes(20)) + bytes([OP_EQUALVERIFY, OP_CHECKSIG])
+    if kind == 'p2sh':
+        return bytes([OP_HASH160]) + push(rng.randbytes(20)) + bytes([OP_EQUAL])
+    if kind == 'p2wpkh':
+        return bytes([OP_0]) + push(rng.randbytes(20))
+    if kind == 'p2wsh':
+        return bytes([OP_0]) + push(rng.randbytes(32))
+    if kind == 'multisig':
+        return bytes([OP_1]) + push(b'\x02' + rng.randbytes(32)) + push(b'\x03' + rng.randbytes(32)) + bytes([OP_1 + 1, OP_CHECKMULTISIG])
+    return bytes([OP_RETURN]) + push(rng.randbytes(rng.randrange(1, 40)))
+
+KINDS = ['p2pkh', 'p2sh', 'p2wpkh', 'p2wsh', 'multisig', 'op_return']
+
+def transaction(rng, inputs, outputs, segwit, coinbase=False):
+    # serialize a tx with the given number of inputs and outputs
+    data = struct.pack('<I', rng.choice([1, 2]))
+    if segwit:
+        data += b'\x00\x01'
+    data += varint(inputs)
+    for i in range(inputs):
+        if coinbase:
+            data += b'\x00' * 32 + b'\xff' * 4
+        else:
+            data += rng.randbytes(32) + struct.pack('<I', rng.randrange(4))
+        data += push(rng.randbytes(rng.choice([0, 71, 106])))
+        data += struct.pack('<I', 0xFFFFFFFF)
+    data += varint(outputs)
+    for i in range(outputs):
+        data += struct.pack('<Q', rng.randrange(10**9)) + push(script_pubkey(rng, rng.choice(KINDS)))
+    if segwit:
+        for i in range(inputs):
+            items = [rng.randbytes(rng.choice([0, 33, 72])) for j in range(rng.randrange(3))]
+            data += varint(len(items)) + b''.join(varint(len(item)) + item for item in items)
+    data += struct.pack('<I', 0)
+    return data
+
+def block(ntx, seed=0, segwit=True):
+    # serialize a block with ntx txs (the first being the coinbase) and its
+    # undo data; returns both and the position of each tx in the block
+    rng = random.Random(seed)
+    txs = [transaction(rng, 1, 2, segwit, coinbase=True)]
+    inputs = []
+    for i in range(ntx - 1):
+        inputs.append(rng.randrange(1, 4))
+        txs.append(transaction(rng, inputs[-1], rng.randrange(1, 4), segwit and rng.random() < 0.5))
+
+    header = struct.pack('<I', 0x20000000) + rng.randbytes(64) + struct.pack('<I', 1600000000) + rng.randbytes(8)
+    raw = header + varint(ntx)
+    offsets = []
+    for tx in txs:
+        offsets.append(len(raw))
+        raw += tx
+
+    # undo data: one P2PKH coin per input, created at some earlier height
+    undo = varint(ntx - 1)
+    for count in inputs:
+        undo += varint(count)
+        for i in range(count):
+            height = rng.randrange(1, 100000)
+            undo += core_varint(height * 2) + core_varint(0)
+            undo += core_varint(compress_amount(rng.randrange(10**9))) + core_varint(0) + rng.randbytes(20)
+    return raw, undo, offsets
+
+def dump(b):
+    # all of a block's fields as nested tuples of plain values
+    txs = []
+    for tx in b.transactions:
+        inputs = tuple((inp.txid, inp.pos, bytes(inp.script_sig.data), inp.seq_no, inp.size,
+                        None if inp.witness is None else (tuple(bytes(item) for item in inp.witness.items), inp.witness.size))
+                       for inp in tx.inputs)
+        outputs = tuple((output.amount, output.script_pubkey.data, output.created_UTXO_type, output.size) for output in tx.outputs)
+        txs.append((tx.version, tx.is_segwit, tx.locktime, tx.size, tx.stripped_size, tx.weight, tx.txid, inputs, outputs))
+    return (b.version, b.prev_hash, b.merkle_root, b.timestamp, b.diffbits, b.nonce, b.ntx, b.size, tuple(txs))
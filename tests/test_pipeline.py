@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Decode synthetic blocks (see synthetic.py) in this process, in each of the
+# decoding pools and in chunks (TxDecoder), and make sure the results are
+# identical. Run with pytest from the repository's root directory.
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.Block import Block
+from lib.Pipeline import DecodePool, ThreadDecodePool, TxDecoder, decode_blocks
+from lib.BlockRing import RingDecodePool, tables
+from lib.TxOffsets import TxOffsets
+from lib.Logger import Logger
+from lib.Window import Window
+from lib.globals import window_sizes
+import lib.statistics
+import lib.Window
+
+import synthetic
+
+# number of txs of each block; the first one stands in for the genesis block,
+# which has no undo data
+SIZES = [1, 2, 40, 300, 1, 7, 1200, 3]
+
+def read_blocks():
+    # same as lib/BlockReader.read_blocks(), but for synthetic blocks
+    for height, ntx in enumerate(SIZES):
+        raw, raw_undo, offsets = synthetic.block(ntx, seed=height)
+        yield height, raw, raw_undo if height > 0 else None
+
+def connected(b, spent):
+    # fee of each tx and spent UTXO type of each input
+    b.connect(spent=spent)
+    if hasattr(b, 'fees'):
+        return b.fees, b.spent_types
+    return [tx.fee for tx in b.transactions], [inp.spent_UTXO_type for tx in b.transactions for inp in tx.inputs]
+
+def statistics(decoded, directory, monkeypatch):
+    # collect the statistics (see lib/statistics.py) for decoded blocks with
+    # undo data, written to directory; returns the contents of the output
+    # files and the histograms
+    logger = Logger(str(directory))
+    monkeypatch.setattr(lib.statistics, 'log', logger)
+    monkeypatch.setattr(lib.Window, 'log', logger)
+    monkeypatch.setattr(lib.statistics, 'flow', {'created': 0, 'spent': 0, 'last': None})
+    window = Window(window_sizes)
+    for height, b, spent in decoded:
+        b.connect(spent=spent)
+        lib.statistics.process(b, height, window, undo=True)
+    logger.close()
+    output = {}
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename)) as f:
+            output[filename] = f.read()
+    return output, logger.histograms
+
+def serial(parser, undo):
+    return [(height, synthetic.dump(b), spent) for height, b, spent in decode_blocks(read_blocks(), parser, undo)]
+
+@pytest.mark.parametrize('parser', ['buffer', 'stream'])
+@pytest.mark.parametrize('undo', [False, True])
+def test_decode_pool(parser, undo):
+    # small batches, so blocks are spread over several batches in flight
+    pool = DecodePool(2, depth=2, batch_bytes=20000, parser=parser, undo=undo)
+    try:
+        decoded = [(height, synthetic.dump(b), spent) for height, b, spent in pool.map(read_blocks())]
+    finally:
+        pool.close()
+    assert decoded == serial(parser, undo)
+
+@pytest.mark.parametrize('parser', ['buffer', 'stream'])
+def test_decode_pool_statistics(parser, tmp_path, monkeypatch):
+    # the statistics written for blocks decoded in worker processes must be
+    # identical to those of a serial run
+    expected = statistics(decode_blocks(read_blocks(), parser, undo=True), tmp_path / 'serial', monkeypatch)
+    assert 'block_size-1.dat' in expected[0] and 'lost_subsidy.dat' in expected[0]
+    pool = DecodePool(2, depth=2, batch_bytes=20000, parser=parser, undo=True)
+    try:
+        decoded = statistics(pool.map(read_blocks()), tmp_path / 'pool', monkeypatch)
+    finally:
+        pool.close()
+    assert decoded == expected
+
+@pytest.mark.parametrize('undo', [False, True])
+def test_thread_decode_pool(undo):
+    pool = ThreadDecodePool(2, depth=2, batch_bytes=20000, undo=undo)
+    try:
+        decoded = [(height, synthetic.dump(b), spent) for height, b, spent in pool.map(read_blocks())]
+    finally:
+        pool.close()
+    assert decoded == serial('buffer', undo)
+
+@pytest.mark.parametrize('parser', ['buffer', 'stream'])
+@pytest.mark.parametrize('undo', [False, True])
+def test_ring_decode_pool(parser, undo):
+    # the blocks received through the ring buffers must have the same tables
+    # as the blocks decoded in this process, and, with undo data, the same
+    # fees and spent UTXO types; a small ring buffer makes the workers wrap
+    # around and wait for space to be released
+    expected = []
+    for height, b, spent in decode_blocks(read_blocks(), parser, undo):
+        txs, inputs, items, outputs, txids = tables(b)
+        entries = [entry for tx_entries in spent for entry in tx_entries] if undo else None
+        expected.append((height, b.size, txids, txs, inputs, items, outputs, entries, connected(b, spent) if undo else None))
+
+    pool = RingDecodePool(2, depth=2, batch_bytes=20000, capacity=1024*1024, parser=parser, undo=undo)
+    try:
+        received = []
+        for height, b, spent in pool.map(read_blocks()):
+            received.append((height, b.size, b.txids, b.txs.tolist(), b.inputs.tolist(), b.items.tolist(), b.outputs.tolist(),
+                             spent.tolist() if undo else None, connected(b, spent) if undo else None))
+        b = spent = None
+    finally:
+        pool.close()
+    assert received == expected
+    assert pool.blocks == len(SIZES)
+
+def test_ring_statistics(tmp_path, monkeypatch):
+    # the statistics must be identical for blocks received through the ring
+    # buffers, which are read through views of their tables (see TxView)
+    expected = statistics(decode_blocks(read_blocks(), undo=True), tmp_path / 'serial', monkeypatch)
+    assert 'block_size-1.dat' in expected[0] and 'lost_subsidy.dat' in expected[0]
+    pool = RingDecodePool(2, depth=2, batch_bytes=20000, capacity=1024*1024, undo=True)
+    try:
+        received = statistics(pool.map(read_blocks()), tmp_path / 'ring', monkeypatch)
+    finally:
+        pool.close()
+    assert received == expected
+
+@pytest.fixture(scope='module')
+def large_block():
+    # more txs than the smallest blocks recorded by TxOffsets
+    return synthetic.block(3000, seed=25)
+
+@pytest.mark.parametrize('chunks', [1, 2, 3, 7, 64, 2999, 3000, 3100])
+def test_tx_decoder(large_block, chunks):
+    # chunked decoding must give the same block as serial decoding, whatever
+    # the chunk boundaries, including more chunks than txs
+    raw, raw_undo, offsets = large_block
+    decoder = TxDecoder(2, chunks)
+    try:
+        b = Block.from_buffer(raw, offsets=offsets, decoder=decoder)
+    finally:
+        decoder.close()
+    assert decoder.blocks == 1
+    assert synthetic.dump(b) == synthetic.dump(Block.from_buffer(raw))
+
+@pytest.mark.parametrize('ntx', [1, 2, 5])
+def test_tx_decoder_small_blocks(ntx):
+    raw, raw_undo, offsets = synthetic.block(ntx, seed=ntx, segwit=False)
+    decoder = TxDecoder(2, 4)
+    try:
+        b = Block.from_buffer(raw, offsets=offsets, decoder=decoder)
+    finally:
+        decoder.close()
+    assert synthetic.dump(b) == synthetic.dump(Block.from_buffer(raw))
+
+def test_tx_decoder_mismatch(large_block):
+    # offsets that do not belong to the block are rejected
+    raw, raw_undo, offsets = large_block
+    decoder = TxDecoder(2, 4)
+    try:
+        with pytest.raises(Exception, match='tx offsets do not match'):
+            Block.from_buffer(raw, offsets=offsets[:-1], decoder=decoder)
+        with pytest.raises(Exception, match='tx offsets do not match'):
+            Block.from_buffer(raw, offsets=[offset + 1 for offset in offsets], decoder=decoder)
+        # a tx in the middle of a chunk does not start where recorded
+        shifted = offsets[:10] + [offsets[10] + 1] + offsets[11:]
+        with pytest.raises(Exception, match='does not start at recorded offset'):
+            Block.from_buffer(raw, offsets=shifted, decoder=decoder)
+    finally:
+        decoder.close()
+
+def test_tx_offsets(large_block, tmp_path):
+    # positions recorded from a deserialized block are those of its txs; they
+    # are ignored once the block at their height has a different hash
+    raw, raw_undo, offsets = large_block
+    blockindex = np.zeros(2, dtype=[('hash', 'u1', 32)])
+    blockindex[1]['hash'] = np.frombuffer(bytes(range(32)), dtype=np.uint8)
+    filename = str(tmp_path / 'tx_offsets')
+
+    tx_offsets = TxOffsets(filename, blockindex)
+    tx_offsets.record(0, Block.from_buffer(raw[:80] + b'\x01' + raw[offsets[0]:offsets[1]]))
+    tx_offsets.record(1, Block.from_buffer(raw))
+    tx_offsets.close()
+    assert tx_offsets.recorded == 1
+
+    tx_offsets = TxOffsets(filename, blockindex)
+    assert tx_offsets.get(0) is None
+    assert tx_offsets.get(1) == offsets
+    # already known, so not recorded again
+    tx_offsets.record(1, Block.from_buffer(raw))
+    assert tx_offsets.recorded == 0
+    tx_offsets.close()
+
+    blockindex[1]['hash'] = 0
+    tx_offsets = TxOffsets(filename, blockindex)
+    assert tx_offsets.get(1) is None
+    tx_offsets.close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Apply the same random blocks to the dict UTXO set and to the NumPy hash
+# table, whose lookups and inserts are batched, and make sure both hold and
+# return the same entries. Run with pytest from the repository's root
+# directory.
+
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.UTXO import UTXO, DUPLICATE_OUTPOINTS
+from lib.HashTableUTXO import HashTableUTXO
+
+def blocks(count, created, seed=0):
+    # spent keys (sorted) and created UTXOs of count blocks; each block spends
+    # most of the UTXOs created so far that are still unspent
+    rng = random.Random(seed)
+    unspent = []
+    for height in range(count):
+        rng.shuffle(unspent)
+        spent = sorted(unspent[:len(unspent) * 3 // 4])
+        unspent = unspent[len(spent):]
+        new = {}
+        for i in range(created):
+            key = rng.randbytes(32) + rng.randrange(4).to_bytes(4, 'big')
+            new[key] = (rng.randrange(10**9), rng.randrange(1, 9), rng.randrange(200), rng.randrange(3), rng.randrange(3))
+        unspent.extend(new)
+        yield spent, new
+
+@pytest.mark.parametrize('capacity', [1 << 4, 1 << 16])
+def test_hash_table(capacity):
+    # a small table is rehashed many times, into larger tables and to drop
+    # tombstones
+    reference = UTXO()
+    table = HashTableUTXO(capacity)
+    for spent, created in blocks(60, 300):
+        assert table.update(spent, dict(created)) == reference.update(spent, dict(created))
+        assert len(table) == len(reference)
+    assert sorted(table.items()) == sorted(reference.items())
+    assert vars(table.aggregates) == vars(reference.aggregates)
+    if capacity < 1 << 16:
+        assert table.rehashes > 0
+
+def test_hash_table_missing_key():
+    # nothing is removed if one of the spent keys is missing
+    table = HashTableUTXO(1 << 4)
+    spent, created = next(blocks(1, 10))
+    table.update(spent, created)
+    keys = sorted(created)
+    with pytest.raises(KeyError):
+        table.consume_many(keys[:3] + [b'\x00' * 36])
+    assert len(table) == 10
+    assert sorted(table.consume_many(keys)) == keys
+    assert len(table) == 0
+
+def test_hash_table_duplicate_outpoint():
+    # outpoints created a second time while unspent replace the first UTXO
+    # (see BIP 30)
+    reference = UTXO()
+    table = HashTableUTXO(1 << 4)
+    key = sorted(DUPLICATE_OUTPOINTS)[0]
+    for amount in [50, 60]:
+        created = {key: (amount * 10**8, 1, 35, 0, 0), b'\x01' * 32 + amount.to_bytes(4, 'big'): (1, 3, 25, 0, 0)}
+        table.update([], dict(created))
+        reference.update([], dict(created))
+    assert sorted(table.items()) == sorted(reference.items())
+    assert vars(table.aggregates) == vars(reference.aggregates)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Compare the hex-string based and the bytes-native decoder for block index
+# records (see create_index_db.py): decode the same records with both, make
+# sure the results are identical and report the time each decoder took.
+
+import os
+import sys
+import time
+import plyvel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from create_index_db import datadir, decode_hex, decode_binary, endian
+
+NUM_RECORDS = 100000    # number of block index records to decode
+REPEAT = 3              # number of runs per decoder; the fastest one counts
+
+def load_records(num_records):
+    # read the first num_records records of blocks with data from the block
+    # index; headers-only and stale blocks without data are included as well
+    db = plyvel.DB(datadir + '/blocks/index', compression=None)
+    records = []
+    for key, value in db.iterator(prefix=b'b'):
+        records.append((endian(key[1:].hex(), 'big'), value))
+        if len(records) == num_records:
+            break
+    db.close()
+    return records
+
+def run(decoder, records):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = [decoder(blockhash, value) for blockhash, value in records]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+records = load_records(NUM_RECORDS)
+print('decoding {} block index records, best of {} runs'.format(len(records), REPEAT))
+
+hex_result, hex_time = run(decode_hex, records)
+binary_result, binary_time = run(decode_binary, records)
+if hex_result != binary_result:
+    mismatch = next(pos for pos in range(len(records)) if hex_result[pos] != binary_result[pos])
+    raise Exception('decoders disagree on block {}: {} vs. {}'.format(records[mismatch][0], hex_result[mismatch], binary_result[mismatch]))
+
+print('hex:    {:.3f}s ({:.1f} us/record)'.format(hex_time, hex_time / len(records) * 1e6))
+print('binary: {:.3f}s ({:.1f} us/record)'.format(binary_time, binary_time / len(records) * 1e6))
+print('speedup: {:.1f}x'.format(hex_time / binary_time))
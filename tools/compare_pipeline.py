@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Compare blocks deserialized in worker processes, returned either pickled
+# (see lib/Pipeline.py) or through ring buffers in shared memory (see
+# lib/BlockRing.py), and blocks deserialized in worker threads with blocks
+# deserialized in this process: decode the same blocks all four ways, make
+# sure every field the statistics depend on is identical and report the time
+# each way took. Blocks received through ring buffers are compared with the
+# tables derived from the blocks deserialized in this process and, with undo
+# data, by their fees and spent UTXO types. Run from the directory containing
+# the block index.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib import BlockIndex
+from lib.BlockReader import MmapBlockReader, read_blocks
+from lib.Pipeline import DecodePool, ThreadDecodePool, decode_blocks, gil_enabled
+from lib.BlockRing import RingDecodePool, tables
+
+datadir = '/scratch/bitcoin-0.19.0.1-datadir/'
+indexdb = 'blockindex.npy'
+START = 0               # first block to compare
+COUNT = None            # number of blocks to compare (None for all)
+PROCESSES = None        # number of worker processes (None for one per CPU)
+PARSER = 'buffer'
+UNDO = True             # compare the spent UTXOs taken from undo data as well
+
+def dump(b):
+    # all of a block's fields as nested tuples of plain values
+    txs = []
+    for tx in b.transactions:
+        inputs = tuple((inp.txid, inp.pos, bytes(inp.script_sig.data), inp.seq_no, inp.size,
+                        None if inp.witness is None else (tuple(bytes(item) for item in inp.witness.items), inp.witness.size))
+                       for inp in tx.inputs)
+        outputs = tuple((output.amount, output.script_pubkey.data, output.created_UTXO_type, output.size) for output in tx.outputs)
+        txs.append((tx.version, tx.is_segwit, tx.locktime, tx.size, tx.stripped_size, tx.weight, tx.txid, inputs, outputs))
+    return (b.version, b.prev_hash, b.merkle_root, b.timestamp, b.diffbits, b.nonce, b.ntx, b.size, tuple(txs))
+
+def connected(b, spent):
+    # fee of each tx and spent UTXO type of each input
+    if not UNDO:
+        return None
+    b.connect(spent=spent)
+    if hasattr(b, 'fees'):
+        return b.fees, b.spent_types
+    return [tx.fee for tx in b.transactions], [inp.spent_UTXO_type for tx in b.transactions for inp in tx.inputs]
+
+def dump_tables(b, spent):
+    # a block received through a ring buffer (see BlockTables), or a block
+    # deserialized in this process in the same format
+    header = (b.version, b.prev_hash, b.merkle_root, b.timestamp, b.diffbits, b.nonce, b.ntx, b.size)
+    if hasattr(b, 'txids'):
+        return header, (b.txids, b.txs.tolist(), b.inputs.tolist(), b.items.tolist(), b.outputs.tolist()), None if spent is None else spent.tolist(), connected(b, spent)
+    txs, inputs, items, outputs, txids = tables(b)
+    return header, (txids, txs, inputs, items, outputs), None if spent is None else [entry for entries in spent for entry in entries], connected(b, spent)
+
+def dump_blocks(b, spent):
+    return dump(b), spent
+
+def run(decoded, dump=dump_blocks):
+    start = time.perf_counter()
+    result = [(height, dump(b, spent)) for height, b, spent in decoded]
+    return result, time.perf_counter() - start
+
+blockindex = BlockIndex.load(indexdb)
+stop = len(blockindex) if COUNT is None else START + COUNT
+reader = MmapBlockReader(datadir)
+
+# create the pools before reading any blocks
+pool = DecodePool(PROCESSES, parser=PARSER, undo=UNDO)
+ring_pool = RingDecodePool(PROCESSES, parser=PARSER, undo=UNDO)
+pooled, pooled_time = run(pool.map(read_blocks(reader, blockindex[:stop], undo=UNDO, start=START)))
+pool.close()
+ringed, ringed_time = run(ring_pool.map(read_blocks(reader, blockindex[:stop], undo=UNDO, start=START)), dump_tables)
+print(ring_pool.stats())
+ring_pool.close()
+thread_pool = ThreadDecodePool(PROCESSES, parser=PARSER, undo=UNDO)
+threaded, threaded_time = run(thread_pool.map(read_blocks(reader, blockindex[:stop], undo=UNDO, start=START)))
+thread_pool.close()
+serial, serial_time = run(decode_blocks(read_blocks(reader, blockindex[:stop], undo=UNDO, start=START), parser=PARSER, undo=UNDO))
+serial_tables, _ = run(decode_blocks(read_blocks(reader, blockindex[:stop], undo=UNDO, start=START), parser=PARSER, undo=UNDO), dump_tables)
+reader.close()
+
+print('decoded blocks {} to {}: {:.1f}s in this process, {:.1f}s (pickled) and {:.1f}s (shared memory) using {} worker processes, {:.1f}s using {} worker threads (GIL {})'.format(START, stop - 1, serial_time, pooled_time, ringed_time, pool.processes, threaded_time, thread_pool.processes, 'enabled' if gil_enabled() else 'disabled'))
+for name, reference, decoded in [('pickled', serial, pooled), ('shared memory', serial_tables, ringed), ('threads', serial, threaded)]:
+    if len(reference) != len(decoded):
+        sys.exit('number of blocks differs ({}): {} vs. {}'.format(name, len(reference), len(decoded)))
+    for a, b in zip(reference, decoded):
+        if a != b:
+            sys.exit('block {} differs ({})'.format(a[0], name))
+print('all {} blocks identical'.format(len(serial)))